@@ -1,21 +1,57 @@
 from __future__ import annotations #only > 3.7, better to find a different solution
 
 import os
+import sys
+import io
+import mmap
+import shutil
+import tempfile
+import uuid
 from abc import ABC, abstractmethod
 import json
+import time
+import sqlite3
+import threading
+import queue
+import itertools
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from contextlib import closing
 
 import hashlib
+import zlib
+import base64
+import ctypes
+import ctypes.util
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    from fastcdc.fastcdc_cy import fastcdc_cy
+except ImportError:
+    fastcdc_cy = None
 from urllib.parse import urlparse
 from urllib.parse import parse_qs
 
+import httplib2
+import requests
+import urllib3
 import google_auth_httplib2
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from google.auth.transport.requests import AuthorizedSession
 import google.oauth2.credentials
 import oauth2client.client
 from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaUpload
 from googleapiclient.http import MediaUploadProgress
 from googleapiclient.http import MediaDownloadProgress
 
@@ -42,6 +78,54 @@ logger = logging.getLogger('drivelib')
 
 minimalChunksize = 1024*256
 defaultChunksize = minimalChunksize*4
+defaultStreamRetries = 5
+defaultMultipartThreshold = defaultChunksize
+minimalReadahead = 1024*64
+maximalReadahead = defaultChunksize*16
+defaultPackSize = defaultChunksize*64
+# Chunk sizes of DedupStore
+minimalDedupChunk = 1024*256
+averageDedupChunk = 1024*1024
+maximalDedupChunk = 1024*1024*4
+checkpointSuffix = '.md5state'
+# Bytes between two checkpoints written during a download
+checkpointInterval = 1024*1024*64
+# Drive discards resumable upload sessions after a week
+sessionLifetime = 60*60*24*7
+# appProperties of files uploaded with a codec or as striped object
+formatProperties = ('drivelibCodec', 'drivelibSize', 'drivelibMd5', 'drivelibStriped')
+
+_stream_errors = (requests.exceptions.ConnectionError,
+                  requests.exceptions.ChunkedEncodingError,
+                  urllib3.exceptions.HTTPError,
+                  ConnectionError)
+
+# hashlib can not export the state of a digest, libcrypto's MD5_CTX is a
+# plain struct that can. Without libcrypto partial files are re-hashed.
+# Loaded on first use only, not on import.
+_libcrypto = None
+_libcrypto_loaded = False
+_libcrypto_lock = threading.Lock()
+
+def _load_libcrypto():
+    global _libcrypto, _libcrypto_loaded
+    with _libcrypto_lock:
+        if _libcrypto_loaded:
+            return _libcrypto
+        _libcrypto_loaded = True
+        name = ctypes.util.find_library('crypto')
+        if sys.platform == 'darwin' and (name is None or os.path.basename(name) == 'libcrypto.dylib'):
+            # macOS aborts processes loading the unversioned system libcrypto
+            return None
+        try:
+            lib = ctypes.CDLL(name or 'libcrypto.so')
+            lib.MD5_Init.argtypes = [ctypes.c_void_p]
+            lib.MD5_Update.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+            lib.MD5_Final.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        except (OSError, AttributeError):
+            return None
+        _libcrypto = lib
+        return _libcrypto
 
 #TODO: Proper Exceptions
 
@@ -54,6 +138,9 @@ class CheckSumError(Exception):
 class AmbiguousPathError(Exception):
     pass
 
+class RemoteFileChangedError(Exception):
+    pass
+
 class Credentials(google.oauth2.credentials.Credentials,
                 oauth2client.client.Credentials):
     #TODO get rid of oauth2client dependency
@@ -82,9 +169,15 @@ class Credentials(google.oauth2.credentials.Credentials,
         return json.dumps(to_serialize)
 
 class ResumableMediaUploadProgress(MediaUploadProgress):
-    def __init__(self, resumable_progress, total_size, resumable_uri):
+    def __init__(self, resumable_progress, total_size, resumable_uri,
+                    resumable_checkpoint=None, http_calls=None):
         super().__init__(resumable_progress, total_size)
         self.resumable_uri = resumable_uri
+        # HTTP requests made by the upload so far
+        self.http_calls = http_calls
+        # MD5 state of the uploaded prefix and the local file's size and
+        # mtime, store it with resumable_uri to avoid re-hashing on resume
+        self.resumable_checkpoint = resumable_checkpoint
 
     def __str__(self):
         return "{}/{} ({:.0%}%) {}".format(
@@ -94,6 +187,55 @@ class ResumableMediaUploadProgress(MediaUploadProgress):
                                 self.resumable_uri
                             )
 
+class ResumableMD5:
+    # MD5 whose state can be saved with state() and restored later
+
+    _ctx_size = 92 # sizeof(MD5_CTX)
+
+    def __init__(self, state: bytes = None):
+        if _load_libcrypto() is None:
+            raise RuntimeError("libcrypto not available")
+        self._ctx = ctypes.create_string_buffer(self._ctx_size)
+        if state:
+            self.length = int.from_bytes(state[self._ctx_size:], 'big')
+            self._ctx.raw = state[:self._ctx_size]
+        else:
+            self.length = 0
+            _libcrypto.MD5_Init(self._ctx)
+
+    @staticmethod
+    def supported() -> bool:
+        return _load_libcrypto() is not None
+
+    def update(self, data):
+        if isinstance(data, bytes):
+            pointer, length = data, len(data)
+        else:
+            view = memoryview(data).cast('B')
+            length = len(view)
+            if view.readonly:
+                pointer = view.tobytes()
+            else:
+                pointer = (ctypes.c_char * length).from_buffer(view)
+        _libcrypto.MD5_Update(self._ctx, pointer, length)
+        self.length += length
+
+    def state(self) -> bytes:
+        return self._ctx.raw + self.length.to_bytes(8, 'big')
+
+    def copy(self) -> ResumableMD5:
+        return ResumableMD5(self.state())
+
+    def digest(self) -> bytes:
+        ctx = ctypes.create_string_buffer(self._ctx.raw, self._ctx_size)
+        digest = ctypes.create_string_buffer(16)
+        _libcrypto.MD5_Final(digest, ctx)
+        return digest.raw
+
+    def hexdigest(self) -> str:
+        return self.digest().hex()
+
+
 class DriveItem(ABC):
     #TODO: metadata as dict
     # Filename not as attribute but as key
@@ -269,6 +411,173 @@ class DriveFolder(DriveItem):
         else:
             return child.create_path(splitpath[1])
 
+    def walk(self, batchsize=50, folders=False):
+        # Lists the subtree level by level, querying the children of up to
+        # batchsize folders at once. Yields (relative path, DriveFile), and
+        # (relative path, DriveFolder) as well if folders is set. Items with
+        # a / in their name, and everything below them, are skipped, and so
+        # are the parts of striped files.
+        fields = self.drive.default_fields + ", size, md5Checksum, appProperties"
+        level = {self.id: ""}
+        while level:
+            folder_ids = list(level)
+            next_level = {}
+            for i in range(0, len(folder_ids), batchsize):
+                batch = folder_ids[i:i+batchsize]
+                query = "({}) and trashed = false".format(" or ".join(
+                            "'{}' in parents".format(id_) for id_ in batch))
+                for item in self.drive.items_by_query(query, pageSize=1000,
+                                                spaces=self.spaces, fields=fields):
+                    parent_id = next(id_ for id_ in item.parent_ids if id_ in level)
+                    if "/" in item.name:
+                        # Would be mistaken for a deeper path
+                        logger.warning("Skipping %s%s: name contains /", level[parent_id], item.name)
+                        continue
+                    if 'drivelibStripe' in (getattr(item, 'app_properties', None) or {}):
+                        continue
+                    path = level[parent_id] + item.name
+                    if item.isfolder():
+                        next_level[item.id] = path + "/"
+                        if folders:
+                            yield path, item
+                    else:
+                        yield path, item
+            level = next_level
+
+    def download_tree(self, local_dir, workers=4, chunksize=None) -> dict:
+        #TODO: Accept Path objects for local_dir
+        files = {}
+        for path, file_ in self.walk():
+            parts = path.split("/")
+            if any(part in ("", ".", "..") or os.sep in part for part in parts):
+                logger.warning("Skipping %s: not a valid local path", path)
+                continue
+            if not hasattr(file_, "_md5_sum"):
+                logger.warning("Skipping %s: Google Docs can not be downloaded", path)
+                continue
+            local_file = os.path.join(local_dir, *parts)
+            if local_file in files:
+                raise AmbiguousPathError("Two or more files {}".format(path))
+            files[local_file] = file_
+
+        for local_file in files:
+            os.makedirs(os.path.dirname(local_file), exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._download_tree_file, file_, local_file, chunksize)
+                            for local_file, file_ in files.items()]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        return {local_file: file_.id for local_file, file_ in files.items()}
+
+    def upload_tree(self, local_dir, workers=4, chunksize=None, journal=None) -> dict:
+        #TODO: Accept Path objects for local_dir
+        # What is already there is listed once, so a restarted upload only
+        # creates missing folders and skips files that match
+        remote = {}
+        for path, item in self.walk(folders=True):
+            if path in remote:
+                raise AmbiguousPathError("Two or more files {}".format(path))
+            remote[path] = item
+
+        levels = []
+        files = {}
+        local_dir = os.path.abspath(local_dir)
+        for dirpath, dirnames, filenames in os.walk(local_dir):
+            relpath = os.path.relpath(dirpath, local_dir)
+            parts = [] if relpath == "." else relpath.split(os.sep)
+            if parts:
+                while len(levels) < len(parts):
+                    levels.append([])
+                levels[len(parts)-1].append("/".join(parts))
+            for filename in filenames:
+                files[os.path.join(dirpath, filename)] = "/".join(parts + [filename])
+
+        folder_ids = {"": self.id}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Folders of one depth only depend on the level above
+            for level in levels:
+                missing = []
+                for path in level:
+                    item = remote.get(path)
+                    if item is None:
+                        missing.append(path)
+                    elif not item.isfolder():
+                        raise FileExistsError("Filename already exists ({name}) and it's not a folder.".format(name=path))
+                    else:
+                        folder_ids[path] = item.id
+                created = executor.map(self._create_tree_folder, missing,
+                            [folder_ids[path.rpartition("/")[0]] for path in missing])
+                folder_ids.update(zip(missing, created))
+
+            futures = {}
+            for local_file, path in files.items():
+                parent, _, name = path.rpartition("/")
+                file_ = remote.get(path)
+                if file_ is None:
+                    file_ = DriveFile(self.drive, [folder_ids[parent]], name)
+                elif file_.isfolder():
+                    raise FileExistsError("Folder already exists ({name}).".format(name=path))
+                futures[executor.submit(self._upload_tree_file, file_, local_file,
+                                            chunksize, journal)] = local_file
+            manifest = {}
+            try:
+                for future in as_completed(futures):
+                    manifest[futures[future]] = future.result().id
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        return manifest
+
+    def _create_tree_folder(self, path, parent_id):
+        file_metadata = {
+            'name': path.rpartition("/")[2],
+            'mimeType': 'application/vnd.google-apps.folder',
+            'parents': [parent_id]
+        }
+        return self.drive.service.files().create(body=file_metadata, fields='id').execute()['id']
+
+    @staticmethod
+    def _upload_tree_file(file_, local_file, chunksize, journal):
+        # Files already in place are skipped using size and md5 from the
+        # listing, changed ones get a new revision
+        if file_.id and hasattr(file_, "_md5_sum") \
+                and os.path.getsize(local_file) == file_.size \
+                and DriveFile._file_md5(local_file, journal) == file_.md5sum:
+            return file_
+        file_.upload(local_file, chunksize=chunksize, journal=journal)
+        return file_
+
+    @staticmethod
+    def _download_tree_file(file_, local_file, chunksize):
+        # Partial files are resumed by download(), complete ones skipped
+        try:
+            local_file_size = os.path.getsize(local_file)
+        except FileNotFoundError:
+            local_file_size = None
+        if (file_.app_properties or {}).get('drivelibStriped'):
+            # Reassembled from its parts, skipped if every part matches
+            if local_file_size != int(file_.app_properties['drivelibSize']) \
+                    or not file_._stripes_match(local_file):
+                file_.download(local_file, chunksize=chunksize, decode=True)
+            return
+        if local_file_size == file_.size:
+            md5 = hashlib.md5()
+            with open(local_file, "rb") as f:
+                for chunk in iter(lambda: f.read(defaultChunksize), b""):
+                    md5.update(chunk)
+            if md5.hexdigest() == file_.md5sum:
+                return
+        if local_file_size is not None and local_file_size >= file_.size:
+            os.remove(local_file)
+        file_.download(local_file, chunksize=chunksize)
+
     def isempty(self) -> bool:
         gen = self.children(pageSize=1)
         if next(gen, None) is None:
@@ -280,7 +589,14 @@ class DriveFolder(DriveItem):
         if reply['mimeType'] == 'application/vnd.google-apps.folder':
             return DriveFolder(self.drive, reply.get('parents', []), reply['name'], reply['id'], spaces=",".join(reply['spaces']))
         else:
-            return DriveFile(self.drive, reply.get('parents', []), reply['name'], reply['id'], spaces=",".join(reply['spaces']))
+            file_ = DriveFile(self.drive, reply.get('parents', []), reply['name'], reply['id'], spaces=",".join(reply['spaces']))
+            if 'size' in reply:
+                file_._size = int(reply['size'])
+            if 'md5Checksum' in reply:
+                file_._md5_sum = reply['md5Checksum']
+            if 'appProperties' in reply:
+                file_.app_properties = reply['appProperties']
+            return file_
 
 class DriveFile(DriveItem):  
 
@@ -290,89 +606,962 @@ class DriveFile(DriveItem):
     def __init__(self, drive, parent_ids, filename, file_id=None, spaces='drive', resumable_uri=None):
         super().__init__(drive, parent_ids, filename, file_id, spaces)
         self.resumable_uri = resumable_uri
+        self.resumable_checkpoint = None
+        self.download_revision = None
+        self.upload_http_calls = None
+        # Only filled in by listings that ask for appProperties
+        self.app_properties = None
+        self.striped_state = None
         
-    def download(self, local_file, chunksize=None, progress_handler=None):
+    def download(self, local_file, chunksize=None, progress_handler=None,
+                    workers=1, stream=False, cache=None, pin_revision=False,
+                    decode=False):
         if not chunksize:
             chunksize = defaultChunksize
         #TODO: Accept Path objects for local_file
         if not self.id:
             raise FileNotFoundError
+        if decode:
+            app_properties = self.meta_get("appProperties").get('appProperties', {})
+            if app_properties.get('drivelibStriped'):
+                self._download_striped(local_file, chunksize, progress_handler, workers)
+                return
+            if app_properties.get('drivelibCodec'):
+                self._download_decoded(local_file, app_properties, chunksize=chunksize,
+                        progress_handler=progress_handler, workers=workers,
+                        stream=stream, cache=cache, pin_revision=pin_revision)
+                return
+        if pin_revision:
+            # Fetch the bytes of one specific revision so that a concurrent
+            # update of the file can not end up mixed into the local copy.
+            # download_revision survives an interrupted download like
+            # resumable_uri does for uploads.
+            try:
+                revision, remote_file_size, remote_md5 = self._pinned_revision()
+            except RemoteFileChangedError:
+                self._discard_download(local_file)
+                raise
+        else:
+            # Size and checksum are fetched fresh, a cached md5sum may
+            # belong to an older version of the file
+            revision = None
+            remote_file_size, remote_md5 = self._fetch_size_md5()
+
+        if cache and cache.fetch(remote_md5, local_file):
+            self.download_revision = None
+            self._remove_checkpoint(local_file)
+            return
 
-        range_md5 = hashlib.md5()
-        try:
-            local_file_size = os.path.getsize(local_file)
-            with open(local_file, "rb") as f:
-                for chunk in iter(lambda: f.read(chunksize), b""):
-                    range_md5.update(chunk)
-        except FileNotFoundError:
-            local_file_size = 0
-        
-
-        remote_file_size = int(self.drive.service.files().\
-                            get(fileId=self.id, fields="size").\
-                            execute()['size'])
-        
-        download_url = "https://www.googleapis.com/drive/v3/files/{fileid}?alt=media".\
-                                format(fileid=self.id)
+        range_md5, local_file_size = self._local_md5(local_file, chunksize)
+        checkpoint_at = local_file_size+checkpointInterval
         
-        with open(local_file, 'ab') as fh:
-            while local_file_size < remote_file_size:
-                download_range = "bytes={}-{}".\
-                    format(local_file_size, local_file_size+chunksize-1)
-                    
-                # replace with googleapiclient.http.HttpRequest if possible
-                # or patch MediaIoBaseDownload to support Range
-                resp, content = self.drive.service._http.request(
-                                            download_url,
-                                            headers={'Range': download_range})
-                if resp.status == 206:
+        try:
+            if workers > 1:
+                self._download_parallel(local_file, local_file_size, remote_file_size,
+                                        range_md5, chunksize, progress_handler, workers,
+                                        revision)
+            elif stream:
+                with open(local_file, 'ab') as fh, \
+                        closing(self._iter_media(local_file_size, remote_file_size,
+                                                    chunksize, revision=revision)) as chunks:
+                    for chunk in chunks:
+                        fh.write(chunk)
+                        local_file_size+=len(chunk)
+                        range_md5.update(chunk)
+                        if local_file_size >= checkpoint_at:
+                            self._save_checkpoint(local_file, range_md5, fh)
+                            checkpoint_at = local_file_size+checkpointInterval
+                        if progress_handler:
+                            progress_handler(MediaDownloadProgress(local_file_size, remote_file_size))
+            else:
+                with open(local_file, 'ab') as fh:
+                    while local_file_size < remote_file_size:
+                        resp, content = self._download_range(local_file_size,
+                                                    local_file_size+chunksize-1, revision)
                         fh.write(content)
                         local_file_size+=int(resp['content-length'])
                         range_md5.update(content)
+                        if local_file_size >= checkpoint_at:
+                            self._save_checkpoint(local_file, range_md5, fh)
+                            checkpoint_at = local_file_size+checkpointInterval
                         if progress_handler:
                             progress_handler(MediaDownloadProgress(local_file_size, remote_file_size))
-                else:
-                    raise HttpError(resp, content)
-        if range_md5.hexdigest() != self.md5sum:
+        except RemoteFileChangedError:
+            self._discard_download(local_file)
+            raise
+        except BaseException:
+            self._save_checkpoint(local_file, range_md5)
+            raise
+        self.download_revision = None
+        self._remove_checkpoint(local_file)
+        if range_md5.hexdigest() != remote_md5:
             os.remove(local_file)
             raise CheckSumError("Checksum mismatch. Need to repeat download.")
+        if cache:
+            cache.store(range_md5.hexdigest(), local_file)
+
+    def _download_decoded(self, local_file, app_properties, **kwargs):
+        # The stored content is downloaded (and resumed) next to local_file
+        # and checked against the stored checksum, then decoded and checked
+        # against the checksum of the original content
+        codec = app_properties['drivelibCodec']
+        stored_file = "{}.{}".format(local_file, codec)
+        self.download(stored_file, **kwargs)
+        decoder = self._decoder(codec)
+        md5 = hashlib.md5()
+        size = 0
+        tmp_file = "{}.{}.tmp".format(local_file, uuid.uuid4().hex)
+        try:
+            with open(stored_file, 'rb') as fin, open(tmp_file, 'wb') as fout:
+                for chunk in iter(lambda: fin.read(defaultChunksize), b""):
+                    data = decoder.decompress(chunk)
+                    fout.write(data)
+                    md5.update(data)
+                    size += len(data)
+                data = decoder.flush()
+                fout.write(data)
+                md5.update(data)
+                size += len(data)
+            if md5.hexdigest() != app_properties['drivelibMd5'] \
+                    or size != int(app_properties['drivelibSize']):
+                raise CheckSumError("Checksum mismatch of decoded content.")
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+        finally:
+            os.remove(stored_file)
+        os.replace(tmp_file, local_file)
+
+    def _download_striped(self, local_file, chunksize, progress_handler, workers):
+        # Parts are streamed concurrently into their place in the file and
+        # each is checked against the MD5 from the manifest
+        manifest = self._stripe_manifest()
+        write_lock = threading.Lock()
+        bytes_done = 0
+        tmp_file = "{}.{}.tmp".format(local_file, uuid.uuid4().hex)
+
+        def fetch(part):
+            nonlocal bytes_done
+            part_file = DriveFile(self.drive, self.parent_ids, None, part['id'])
+            md5 = hashlib.md5()
+            position = part['offset']
+            with closing(part_file._iter_media(0, part['size'], chunksize)) as chunks:
+                for chunk in chunks:
+                    md5.update(chunk)
+                    with write_lock:
+                        fh.seek(position)
+                        fh.write(chunk)
+                        bytes_done += len(chunk)
+                        if progress_handler:
+                            progress_handler(MediaDownloadProgress(bytes_done, manifest['size']))
+                    position += len(chunk)
+            if md5.hexdigest() != part['md5']:
+                raise CheckSumError("Checksum mismatch of part {}.".format(part['id']))
+
+        try:
+            with open(tmp_file, 'wb') as fh:
+                fh.truncate(manifest['size'])
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(fetch, part) for part in manifest['parts']]
+                    try:
+                        for future in as_completed(futures):
+                            future.result()
+                    except BaseException:
+                        for future in futures:
+                            future.cancel()
+                        raise
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+        os.replace(tmp_file, local_file)
+
+    def _stripe_manifest(self):
+        return json.loads(b"".join(self.iter_content()))
+
+    def _stripes_match(self, local_file):
+        with open(local_file, 'rb') as fh:
+            for part in self._stripe_manifest()['parts']:
+                fh.seek(part['offset'])
+                md5 = hashlib.md5()
+                remaining = part['size']
+                while remaining:
+                    chunk = fh.read(min(remaining, defaultChunksize))
+                    if not chunk:
+                        return False
+                    md5.update(chunk)
+                    remaining -= len(chunk)
+                if md5.hexdigest() != part['md5']:
+                    return False
+        return True
+
+    def _stripe_parts(self):
+        app_properties = self.meta_get("appProperties").get('appProperties', {})
+        if not app_properties.get('drivelibStriped'):
+            return []
+        return self._stripe_manifest()['parts']
+
+    def remove(self):
+        # The parts of a striped file go with it
+        parts = self._stripe_parts()
+        super().remove()
+        self._remove_parts(parts)
+
+    def trash(self):
+        parts = self._stripe_parts()
+        super().trash()
+        for part in parts:
+            DriveFile(self.drive, [], None, part['id']).meta_set({'trashed': True})
+
+    @staticmethod
+    def _encoder(codec):
+        if codec == 'gzip':
+            return zlib.compressobj(wbits=31)
+        if codec == 'zstd':
+            if zstandard is None:
+                raise ImportError("The zstd codec needs the zstandard package")
+            return zstandard.ZstdCompressor().compressobj()
+        raise ValueError("Unsupported codec: {}".format(codec))
+
+    @staticmethod
+    def _decoder(codec):
+        if codec == 'gzip':
+            return zlib.decompressobj(wbits=31)
+        if codec == 'zstd':
+            if zstandard is None:
+                raise ImportError("The zstd codec needs the zstandard package")
+            return zstandard.ZstdDecompressor().decompressobj()
+        raise ValueError("Unsupported codec: {}".format(codec))
+
+    def _pinned_revision(self):
+        result = self.drive.service.files().get(fileId=self.id,
+                            fields="size, md5Checksum, headRevisionId").execute()
+        revision = self.download_revision or result['headRevisionId']
+        if revision != result['headRevisionId']:
+            try:
+                result = self.drive.service.revisions().get(fileId=self.id,
+                            revisionId=revision, fields="size, md5Checksum").execute()
+            except HttpError as e:
+                if e.resp.status == 404:
+                    raise RemoteFileChangedError("Revision {} is no longer available".format(revision))
+                raise
+        self.download_revision = revision
+        return revision, int(result['size']), result['md5Checksum']
+
+    def _discard_download(self, local_file):
+        # The partial file belongs to a revision we can no longer fetch
+        self.download_revision = None
+        self._remove_checkpoint(local_file)
+        try:
+            os.remove(local_file)
+        except FileNotFoundError:
+            pass
+
+    def _local_md5(self, local_file, chunksize):
+        # A checkpoint holds the hash state of the first offset bytes of the
+        # partial file. Anything written after it, e.g. before the process
+        # was killed, is cut off and fetched again. Without a usable
+        # checkpoint the partial file is hashed again.
+        try:
+            stat = os.stat(local_file)
+        except FileNotFoundError:
+            return self._new_md5(), 0
+        try:
+            with open(local_file+checkpointSuffix) as fh:
+                checkpoint = json.load(fh)
+            if ResumableMD5.supported() and checkpoint['id'] == self.id \
+                    and checkpoint['offset'] <= stat.st_size:
+                os.truncate(local_file, checkpoint['offset'])
+                return ResumableMD5(base64.b64decode(checkpoint['md5_state'])), checkpoint['offset']
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+        range_md5 = self._new_md5()
+        with open(local_file, "rb") as f:
+            for chunk in iter(lambda: f.read(chunksize), b""):
+                range_md5.update(chunk)
+        return range_md5, stat.st_size
+
+    @staticmethod
+    def _new_md5():
+        return ResumableMD5() if ResumableMD5.supported() else hashlib.md5()
+
+    def _save_checkpoint(self, local_file, range_md5, fh=None):
+        # Written every checkpointInterval bytes and when a download fails,
+        # so a killed process loses at most that much. The open file is
+        # synced first, the checkpoint must not get ahead of the disk.
+        if not isinstance(range_md5, ResumableMD5):
+            return
+        if fh is not None:
+            fh.flush()
+            os.fsync(fh.fileno())
+        try:
+            stat = os.stat(local_file)
+        except FileNotFoundError:
+            return
+        if stat.st_size < range_md5.length:
+            return
+        checkpoint = {
+            'id': self.id,
+            'offset': range_md5.length,
+            'md5_state': base64.b64encode(range_md5.state()).decode(),
+        }
+        with open(local_file+checkpointSuffix+'.tmp', 'w') as fh:
+            json.dump(checkpoint, fh)
+        os.replace(local_file+checkpointSuffix+'.tmp', local_file+checkpointSuffix)
+
+    @staticmethod
+    def _remove_checkpoint(local_file):
+        try:
+            os.remove(local_file+checkpointSuffix)
+        except FileNotFoundError:
+            pass
+
+    def _download_parallel(self, local_file, local_file_size, remote_file_size,
+                            range_md5, chunksize, progress_handler, workers,
+                            revision=None):
+        # Ranges are fetched concurrently and written at their offset into
+        # the preallocated file. Finished ranges are hashed in order as soon
+        # as the gap before them is closed, reading them back from disk if
+        # they arrived early. On failure the file is cut back to the
+        # contiguous prefix so the next call can resume from there.
+        finished = {}
+        write_lock = threading.Lock()
+
+        with open(local_file, 'ab'):
+            pass
+        with open(local_file, 'r+b') as fh:
+            fh.truncate(remote_file_size)
+
+            def fetch(start):
+                resp, content = self._download_range(start, start+chunksize-1, revision)
+                with write_lock:
+                    fh.seek(start)
+                    fh.write(content)
+                return start, content
+
+            hashed_until = local_file_size
+            checkpoint_at = hashed_until+checkpointInterval
+            bytes_done = local_file_size
+            starts = iter(range(local_file_size, remote_file_size, chunksize))
+            executor = ThreadPoolExecutor(max_workers=workers)
+            # At most 2*workers ranges are in flight or waiting to be
+            # handled, and a future is dropped once it is, so memory does
+            # not grow with the file size
+            pending = set()
+            try:
+                while True:
+                    for start in itertools.islice(starts, 2*workers-len(pending)):
+                        pending.add(executor.submit(fetch, start))
+                    if not pending:
+                        break
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        start, content = future.result()
+                        finished[start] = start+len(content)
+                        bytes_done += len(content)
+                        if start == hashed_until:
+                            range_md5.update(content)
+                            hashed_until = finished[start]
+                            while hashed_until in finished:
+                                with write_lock:
+                                    fh.seek(hashed_until)
+                                    range_md5.update(fh.read(finished[hashed_until]-hashed_until))
+                                hashed_until = finished[hashed_until]
+                            if hashed_until >= checkpoint_at:
+                                with write_lock:
+                                    self._save_checkpoint(local_file, range_md5, fh)
+                                checkpoint_at = hashed_until+checkpointInterval
+                        del content
+                        if progress_handler:
+                            progress_handler(MediaDownloadProgress(bytes_done, remote_file_size))
+                    del done
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                executor.shutdown(wait=True)
+                for future in pending:
+                    if future.done() and not future.cancelled() \
+                            and future.exception() is None:
+                        start, content = future.result()
+                        finished[start] = start+len(content)
+                contiguous = local_file_size
+                while contiguous in finished:
+                    contiguous = finished[contiguous]
+                fh.truncate(contiguous)
+                raise
+            finally:
+                executor.shutdown(wait=True)
+
+    def open(self, mode='rb', cache=None, chunksize=None):
+        if mode == 'wb':
+            return DriveFileWriter(self, chunksize=chunksize)
+        if mode != 'rb':
+            raise ValueError("Unsupported mode: {}".format(mode))
+        if not self.id:
+            raise FileNotFoundError
+        return DriveFileReader(self, cache=cache)
+
+    def download_into(self, buffer, offset=0, length=None, chunksize=None,
+                        progress_handler=None, retries=None) -> int:
+        if not chunksize:
+            chunksize = defaultChunksize
+        if retries is None:
+            retries = defaultStreamRetries
+        if not self.id:
+            raise FileNotFoundError
+        view = memoryview(buffer).cast('B')
+        if view.readonly:
+            raise TypeError("buffer is not writable")
+        size, remote_md5 = self._fetch_size_md5()
+        end = size
+        if length is not None:
+            end = min(offset+length, end)
+        if len(view) < end-offset:
+            raise ValueError("buffer too small ({} < {})".format(len(view), end-offset))
+
+        # Reading from the underlying http.client response lets the socket
+        # fill the buffer directly. urllib3's readinto would copy through
+        # an intermediate bytes object, it is only the fallback in case
+        # urllib3 does not have the private _fp.
+        range_md5 = hashlib.md5() if offset == 0 and end == size else None
+        pos = 0
+        failures = 0
+        while offset+pos < end:
+            resp = None
+            try:
+                resp = self._media_response(offset+pos, end,
+                                            headers={'Accept-Encoding': 'identity'})
+                raw = getattr(resp.raw, '_fp', None)
+                if not hasattr(raw, 'readinto'):
+                    raw = resp.raw
+                while offset+pos < end:
+                    received = raw.readinto(view[pos:min(pos+chunksize, end-offset)])
+                    if not received:
+                        # Counted as a failure, a server that keeps closing
+                        # early must not make us retry forever
+                        raise ConnectionError("Response ended at byte {}".format(offset+pos))
+                    if range_md5:
+                        range_md5.update(view[pos:pos+received])
+                    pos += received
+                    failures = 0
+                    if progress_handler:
+                        progress_handler(MediaDownloadProgress(offset+pos, end))
+            except _stream_errors as e:
+                failures += 1
+                if failures > retries:
+                    raise
+                logger.debug("Connection dropped at byte %d, resuming: %s", offset+pos, e)
+            finally:
+                if resp is not None:
+                    resp.close()
+        if range_md5 and range_md5.hexdigest() != remote_md5:
+            raise CheckSumError("Checksum mismatch. Content is corrupt.")
+        return pos
+
+    def iter_content(self, offset=0, length=None, chunksize=None):
+        if not chunksize:
+            chunksize = defaultChunksize
+        if not self.id:
+            raise FileNotFoundError
+        size, remote_md5 = self._fetch_size_md5()
+        end = size
+        if length is not None:
+            end = min(offset+length, end)
+        # The checksum can only be verified if the whole file is consumed
+        if offset != 0 or end != size:
+            remote_md5 = None
+        return self._iter_content(offset, end, chunksize, remote_md5)
+
+    def _iter_content(self, offset, end, chunksize, remote_md5):
+        range_md5 = hashlib.md5() if remote_md5 else None
+        with closing(self._iter_media(offset, end, chunksize)) as chunks:
+            for chunk in chunks:
+                if range_md5:
+                    range_md5.update(chunk)
+                yield chunk
+        if range_md5 and range_md5.hexdigest() != remote_md5:
+            raise CheckSumError("Checksum mismatch. Content is corrupt.")
+
+    def _iter_media(self, start, end, chunksize, retries=None, revision=None):
+        # Streams bytes start..end-1 from a single GET. A new Range request
+        # is only issued to resume after the connection dropped.
+        if retries is None:
+            retries = defaultStreamRetries
+        failures = 0
+        while start < end:
+            resp = None
+            try:
+                resp = self._media_response(start, end, revision)
+                for chunk in resp.iter_content(chunksize):
+                    start += len(chunk)
+                    failures = 0
+                    yield chunk
+                if start < end:
+                    raise ConnectionError("Response ended at byte {}".format(start))
+            except _stream_errors as e:
+                failures += 1
+                if failures > retries:
+                    raise
+                logger.debug("Connection dropped at byte %d, resuming: %s", start, e)
+            finally:
+                if resp is not None:
+                    resp.close()
+
+    def _fetch_size_md5(self):
+        # Fetched fresh for every transfer, the cached size and md5sum (also
+        # filled in by listings) may belong to an older version of the file
+        result = self.drive.service.files().\
+                            get(fileId=self.id, fields="size, md5Checksum").\
+                            execute()
+        self._size = int(result['size'])
+        self._md5_sum = result['md5Checksum']
+        return self._size, self._md5_sum
+
+    def _media_response(self, start, end, revision=None, headers=None):
+        headers = dict(headers or {}, Range="bytes={}-{}".format(start, end-1))
+        resp = self.drive.session.get(self._media_url(revision),
+                                        headers=headers, stream=True)
+        if resp.status_code == 404 and revision:
+            resp.close()
+            raise RemoteFileChangedError("Revision {} is no longer available".format(revision))
+        if resp.status_code != 206:
+            resp.close()
+            raise HttpError(httplib2.Response(dict(resp.headers, status=resp.status_code)),
+                            resp.content)
+        return resp
+
+    def _media_url(self, revision=None):
+        if revision:
+            return "https://www.googleapis.com/drive/v3/files/{fileid}/revisions/{revision}?alt=media".\
+                                format(fileid=self.id, revision=revision)
+        return "https://www.googleapis.com/drive/v3/files/{fileid}?alt=media".\
+                                format(fileid=self.id)
+
+    def _download_range(self, start, end, revision=None):
+        download_url = self._media_url(revision)
+        download_range = "bytes={}-{}".format(start, end)
+
+        # replace with googleapiclient.http.HttpRequest if possible
+        # or patch MediaIoBaseDownload to support Range
+        resp, content = self.drive.service._http.request(
+                                    download_url,
+                                    headers={'Range': download_range})
+        if resp.status == 404 and revision:
+            raise RemoteFileChangedError("Revision {} is no longer available".format(revision))
+        if resp.status != 206:
+            raise HttpError(resp, content)
+        return resp, content
 
     def upload(self, local_file, chunksize=None,
-                resumable_uri=None, progress_handler=None):
+                resumable_uri=None, progress_handler=None,
+                resumable_checkpoint=None, use_mmap=False, prefetch=0,
+                multipart_threshold=None, journal=None, session_pool=None,
+                codec=None, app_properties=None):
         if not chunksize:
             chunksize = defaultChunksize
+        if multipart_threshold is None:
+            multipart_threshold = defaultMultipartThreshold
+        if codec and (resumable_uri or session_pool or use_mmap or prefetch):
+            raise ValueError("resumable_uri, session_pool, use_mmap and prefetch "
+                                "can not be used with a codec")
         #TODO: Accept Path objects for local_file
+        local_file_size = os.path.getsize(local_file)
         if self.id:
-            raise FileExistsError("Uploading new revision not yet implemented")
-        if os.path.getsize(local_file) == 0:
+            # New revision, unless the content is the same
+            remote = self.meta_get("size, md5Checksum, appProperties")
+            remote_properties = remote.get('appProperties', {})
+            if codec:
+                unchanged = remote_properties.get('drivelibCodec') == codec \
+                    and remote_properties.get('drivelibSize') == str(local_file_size) \
+                    and remote_properties.get('drivelibMd5') == self._file_md5(local_file, journal)
+            else:
+                unchanged = not remote_properties.get('drivelibCodec') \
+                    and not remote_properties.get('drivelibStriped') \
+                    and int(remote.get('size', -1)) == local_file_size \
+                    and remote.get('md5Checksum') == self._file_md5(local_file, journal)
+            if unchanged:
+                self._size = int(remote['size'])
+                self._md5_sum = remote['md5Checksum']
+                self.upload_http_calls = 1
+                if journal:
+                    journal.remove(local_file, self)
+                return
+        if codec:
+            self._upload_encoded(local_file, codec, chunksize, progress_handler,
+                                    journal, app_properties)
+            return
+        if local_file_size == 0 and not self.id:
             self.upload_empty()
+            if journal:
+                journal.remove(local_file, self)
+            return
+        journaled = False
+        if journal and not resumable_uri:
+            entry = journal.lookup(local_file, self)
+            if entry:
+                resumable_uri, resumable_checkpoint = entry
+                journaled = True
+        pooled_uri = None
+        if session_pool and not (self.id or resumable_uri or self.resumable_uri):
+            pooled_uri = session_pool.take(self, app_properties)
+        if local_file_size <= min(multipart_threshold, chunksize) \
+                and not (resumable_uri or self.resumable_uri or pooled_uri):
+            # Fits into a single chunk anyway, so a resumable session
+            # would only add round trips
+            self._upload_multipart(local_file, progress_handler, app_properties)
             return
 
-        media = MediaFileUpload(local_file, resumable=True, chunksize=chunksize)
-        file_metadata = {
-            'name': self.name, 
-            'parents': self.parent_ids
-        }
-                
-        request = ResumableUploadRequest(self.drive.service, media_body=media, body=file_metadata)
+        if use_mmap:
+            media = MmapMediaUpload(local_file, chunksize=chunksize)
+        else:
+            media = MediaFileUpload(local_file, resumable=True, chunksize=chunksize)
+        request = ResumableUploadRequest(self.drive.service, media_body=media,
+                                            body=self._upload_metadata(app_properties),
+                                            prefetch=prefetch, file_id=self.id)
         if resumable_uri:
             self.resumable_uri = resumable_uri
-        request.resumable_uri=self.resumable_uri
+            self.resumable_checkpoint = resumable_checkpoint
+        if pooled_uri:
+            request.use_new_session(pooled_uri)
+        else:
+            request.resumable_uri=self.resumable_uri
+            request.md5_state = self._checkpoint_md5_state(local_file, self.resumable_checkpoint)
             
         response = None
-        while not response:
-            try:
-                status, response = request.next_chunk()
-            except CheckSumError:
-                self.resumable_uri = None
-                raise
-            self.resumable_uri = request.resumable_uri
-            if status and progress_handler:
-                progress_handler(status)
+        try:
+            while not response:
+                try:
+                    status, response = request.next_chunk()
+                except CheckSumError:
+                    self.resumable_uri = None
+                    self.resumable_checkpoint = None
+                    if journal:
+                        journal.remove(local_file, self)
+                    raise
+                except HttpError as e:
+                    # The session from the journal is no longer known to
+                    # Drive, start over with a new one below
+                    if not journaled or e.resp.status not in (404, 410):
+                        raise
+                    break
+                self.resumable_uri = request.resumable_uri
+                self.resumable_checkpoint = self._upload_checkpoint(local_file, request.md5_state)
+                if journal and not response:
+                    journal.record(local_file, self, self.resumable_uri,
+                                    request.resumable_progress, self.resumable_checkpoint)
+                if status and progress_handler:
+                    status.resumable_checkpoint = self.resumable_checkpoint
+                    progress_handler(status)
+        finally:
+            self.upload_http_calls = request.http_calls
+            request.close()
+            if use_mmap:
+                media.close()
+        if response is None:
+            journal.remove(local_file, self)
+            self.resumable_uri = None
+            self.resumable_checkpoint = None
+            self.upload(local_file, chunksize=chunksize, progress_handler=progress_handler,
+                        use_mmap=use_mmap, prefetch=prefetch,
+                        multipart_threshold=multipart_threshold, journal=journal,
+                        session_pool=session_pool, app_properties=app_properties)
+            return
         result = json.loads(response)
+        if journal:
+            journal.remove(local_file, self)
+        self._set_uploaded(result, local_file_size)
+        self.resumable_uri = None
+        self.resumable_checkpoint = None
+
+    def _upload_multipart(self, local_file, progress_handler=None, app_properties=None):
+        with open(local_file, 'rb') as fh:
+            content = fh.read()
+        boundary = uuid.uuid4().hex.encode()
+        body = b"".join((
+            b"--", boundary, b"\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n",
+            json.dumps(self._upload_metadata(app_properties)).encode(),
+            b"\r\n--", boundary, b"\r\nContent-Type: application/octet-stream\r\n\r\n",
+            content,
+            b"\r\n--", boundary, b"--",
+        ))
+        if self.id:
+            api_url = "https://www.googleapis.com/upload/drive/v3/files/{}?uploadType=multipart&fields=id,name,md5Checksum".format(self.id)
+        else:
+            api_url = "https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart&fields=id,name,md5Checksum"
+        status, resp = self.drive.service._http.request(api_url, method='PATCH' if self.id else 'POST',
+                            headers={'Content-Type': 'multipart/related; boundary={}'.format(boundary.decode()),
+                                     'Content-Length': str(len(body))},
+                            body=body)
+        if status['status'] != '200':
+            raise HttpError(status, resp)
+        result = json.loads(resp)
+        logger.debug("Remote MD5: %s", result['md5Checksum'])
+        if result['md5Checksum'] != hashlib.md5(content).hexdigest():
+            raise CheckSumError("Final checksum mismatch. Need to repeat upload.")
+        self._set_uploaded(result, len(content))
+        self.upload_http_calls = 1
+        if progress_handler:
+            progress_handler(ResumableMediaUploadProgress(len(content), len(content), None,
+                                                            http_calls=1))
+
+    def _upload_metadata(self, app_properties=None):
+        # The parents of an existing file can not be set by an update. A new
+        # revision drops the codec properties of the previous one.
+        if self.id:
+            metadata = {'appProperties': dict.fromkeys(formatProperties)}
+            metadata['appProperties'].update(app_properties or {})
+            return metadata
+        metadata = {
+            'name': self.name,
+            'parents': self.parent_ids
+        }
+        if app_properties:
+            metadata['appProperties'] = app_properties
+        return metadata
+
+    def _upload_encoded(self, local_file, codec, chunksize, progress_handler,
+                        journal=None, app_properties=None):
+        # Compressed size is unknown up front, so this is a stream upload.
+        # Original size and MD5 go to appProperties for download(decode=True).
+        # The compressor state can not be restored, so unlike a plain upload
+        # this can not be resumed after the connection dropped, it has to be
+        # started again. The journal only caches the MD5 of the local file.
+        encoder = self._encoder(codec)
+        chunksize = -(-chunksize // minimalChunksize) * minimalChunksize
+        local_file_size = os.path.getsize(local_file)
+        original_md5 = self._file_md5(local_file, journal)
+        app_properties = dict(app_properties or {},
+            drivelibCodec=codec,
+            drivelibSize=str(local_file_size),
+            drivelibMd5=original_md5,
+        )
+
+        def encoded_chunks():
+            md5 = hashlib.md5()
+            size = 0
+            with open(local_file, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(chunksize), b""):
+                    md5.update(chunk)
+                    size += len(chunk)
+                    yield encoder.compress(chunk)
+            # Raised before the last chunk is sent
+            if md5.hexdigest() != original_md5 or size != local_file_size:
+                raise CheckSumError("Local file changed during upload.")
+            yield encoder.flush()
+
+        self._upload_chunks(self._stream_chunks(encoded_chunks(), chunksize),
+                            progress_handler, app_properties)
+
+    def _set_uploaded(self, result, size):
+        # Size and checksum cached before belong to the previous revision
         self.id = result['id']
         self.name = result['name']
-        self.resumable_uri = None
+        self._size = size
+        if 'md5Checksum' in result:
+            self._md5_sum = result['md5Checksum']
+        elif hasattr(self, '_md5_sum'):
+            del self._md5_sum
+
+    @staticmethod
+    def _file_md5(local_file, journal=None):
+        if journal:
+            return journal.local_md5(local_file)
+        md5 = hashlib.md5()
+        with open(local_file, "rb") as f:
+            for chunk in iter(lambda: f.read(defaultChunksize), b""):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    @staticmethod
+    def _upload_checkpoint(local_file, md5_state):
+        if not md5_state:
+            return None
+        stat = os.stat(local_file)
+        return json.dumps({
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'md5_state': md5_state,
+        })
+
+    @staticmethod
+    def _checkpoint_md5_state(local_file, checkpoint):
+        # Like download checkpoints, only trusted if the local file was not
+        # modified since it was written
+        try:
+            checkpoint = json.loads(checkpoint)
+            stat = os.stat(local_file)
+            if checkpoint['size'] == stat.st_size \
+                    and checkpoint['mtime_ns'] == stat.st_mtime_ns:
+                return checkpoint['md5_state']
+        except (TypeError, ValueError, KeyError, FileNotFoundError):
+            pass
+        return None
+
+    def upload_striped(self, local_file, stripes=None, workers=4, chunksize=None,
+                        striped_state=None, retries=None):
+        # Drive has no parallel upload of a single file, so the file is split
+        # into stripes uploaded concurrently as files of their own in the
+        # ".stripes" folder next to this one. This file then holds a JSON
+        # manifest of the parts, which download(decode=True) reassembles. A
+        # new revision removes the parts of the previous one.
+        # Each stripe is retried up to retries times, resuming its session.
+        # If a stripe still fails, finished parts and open sessions are kept
+        # in striped_state (JSON-serializable, like resumable_uri), and
+        # calling again with the same file only uploads what is missing.
+        #TODO: Accept Path objects for local_file
+        if not chunksize:
+            chunksize = defaultChunksize
+        if not stripes:
+            stripes = workers
+        if retries is None:
+            retries = defaultStreamRetries
+        stat = os.stat(local_file)
+        local_file_size = stat.st_size
+        # Stripes are whole chunks, only the last one can be shorter
+        stripe_size = max(-(-local_file_size // stripes), 1)
+        stripe_size = -(-stripe_size // chunksize) * chunksize
+
+        if striped_state:
+            self.striped_state = striped_state
+        state = self.striped_state
+        if state and (state['size'], state['mtime_ns'], state['stripe_size']) \
+                != (local_file_size, stat.st_mtime_ns, stripe_size):
+            # Parts of a different version of the file
+            self._remove_parts(state['parts'])
+            state = None
+        if not state:
+            state = {
+                'size': local_file_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'stripe_size': stripe_size,
+                'folder': self.parent.mkdir(".stripes").id,
+                'key': uuid.uuid4().hex,
+                'parts': [{'id': None, 'md5': None, 'resumable_uri': None}
+                            for offset in range(0, local_file_size, stripe_size)],
+            }
+        self.striped_state = state
+
+        old_parts = []
+        if self.id and self.meta_get("appProperties").get('appProperties', {}).get('drivelibStriped'):
+            old_parts = self._stripe_manifest()['parts']
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for index, part_state in enumerate(state['parts']):
+                if part_state['id']:
+                    continue
+                offset = index*stripe_size
+                part = DriveFile(self.drive, [state['folder']], "{}.{:04d}".format(state['key'], index))
+                futures.append(executor.submit(part._upload_stripe, local_file, offset,
+                                    min(stripe_size, local_file_size-offset), chunksize,
+                                    index, part_state, retries))
+            # Stripes already running are allowed to finish so their
+            # progress is kept
+            for future in as_completed(futures):
+                future.result()
+
+        manifest = {
+            'size': local_file_size,
+            'parts': [{
+                'id': part_state['id'],
+                'offset': index*stripe_size,
+                'size': min(stripe_size, local_file_size-index*stripe_size),
+                'md5': part_state['md5'],
+            } for index, part_state in enumerate(state['parts'])],
+        }
+        app_properties = {
+            'drivelibStriped': str(len(manifest['parts'])),
+            'drivelibSize': str(local_file_size),
+        }
+        self._upload_chunks(iter([json.dumps(manifest).encode()]), app_properties=app_properties)
+        self.striped_state = None
+        self._remove_parts(old_parts)
+
+    def _remove_parts(self, parts):
+        for part in parts:
+            if part['id']:
+                try:
+                    self.drive.service.files().delete(fileId=part['id']).execute()
+                except HttpError as e:
+                    if e.resp.status != 404:
+                        raise
+
+    def _upload_stripe(self, local_file, offset, length, chunksize, index, part_state, retries):
+        failures = 0
+        while True:
+            media = MmapMediaUpload(local_file, chunksize=chunksize, offset=offset, length=length)
+            request = ResumableUploadRequest(self.drive.service, media_body=media,
+                            body=self._upload_metadata({'drivelibStripe': str(index)}))
+            request.resumable_uri = part_state['resumable_uri']
+            response = None
+            try:
+                while not response:
+                    status, response = request.next_chunk()
+                    part_state['resumable_uri'] = request.resumable_uri
+                break
+            except (CheckSumError, HttpError, OSError, httplib2.HttpLib2Error) as e:
+                failures += 1
+                if isinstance(e, CheckSumError) or \
+                        (isinstance(e, HttpError) and e.resp.status in (404, 410)):
+                    # The session can not be continued
+                    part_state['resumable_uri'] = None
+                if failures > retries:
+                    raise
+                logger.debug("Stripe %d failed, retrying: %s", index, e)
+            finally:
+                request.close()
+                media.close()
+        self._set_uploaded(json.loads(response), length)
+        part_state.update(id=self.id, md5=self.md5sum, resumable_uri=None)
+
+    def upload_stream(self, stream, chunksize=None, progress_handler=None):
+        # stream is a readable file-like or an iterable of bytes. Nothing is
+        # buffered beyond the current and the next chunk, so a failed upload
+        # can not be resumed.
+        if not chunksize:
+            chunksize = defaultChunksize
+        chunksize = -(-chunksize // minimalChunksize) * minimalChunksize
+
+        self._upload_chunks(self._stream_chunks(stream, chunksize), progress_handler)
+
+    def _upload_chunks(self, chunks, progress_handler=None, app_properties=None):
+        content = next(chunks, None)
+        if content is None:
+            if not self.id and not app_properties:
+                self.upload_empty()
+                return
+            content = b""
+
+        request = StreamUploadRequest(self.drive.service,
+                                        body=self._upload_metadata(app_properties),
+                                        file_id=self.id)
+        while content is not None:
+            next_content = next(chunks, None)
+            try:
+                status, response = request.send(content, last=next_content is None)
+            finally:
+                self.upload_http_calls = request.http_calls
+            if progress_handler:
+                progress_handler(status)
+            content = next_content
+        result = json.loads(response)
+        self._set_uploaded(result, request._resumable_progress)
+
+    @staticmethod
+    def _stream_chunks(stream, chunksize):
+        # Regroups whatever the source yields into chunks of chunksize
+        if hasattr(stream, 'read'):
+            source = iter(lambda: stream.read(chunksize), b"")
+        else:
+            source = stream
+        buffer = bytearray()
+        for data in source:
+            buffer += data
+            while len(buffer) >= chunksize:
+                yield bytes(buffer[:chunksize])
+                del buffer[:chunksize]
+        if buffer:
+            yield bytes(buffer)
 
     def upload_empty(self):
         file_metadata = {
@@ -382,10 +1571,11 @@ class DriveFile(DriveItem):
         result = self.drive.service.files().create(body=file_metadata, fields=self.drive.default_fields).execute()
         self.id = result['id']
         self.name = result['name']
+        self.upload_http_calls = 1
        
     @property
     def md5sum(self):
-        if not hasattr(self, "_md5sum"):
+        if not hasattr(self, "_md5_sum"):
             self._md5_sum = self.meta_get("md5Checksum")["md5Checksum"]
         return self._md5_sum
        
@@ -396,17 +1586,980 @@ class DriveFile(DriveItem):
         return self._size
 
 
+class DriveFileReader(io.RawIOBase):
+    # Maps reads to Range requests. The readahead window doubles on every
+    # sequential miss and falls back to minimalReadahead after a seek.
+
+    def __init__(self, drive_file, cache=None):
+        self.drive_file = drive_file
+        self.cache = cache
+        if cache:
+            meta = drive_file.meta_get("size, headRevisionId")
+            self._size = int(meta['size'])
+            self._revision = meta.get('headRevisionId', '')
+        else:
+            self._size = drive_file.size
+        self._pos = 0
+        self._buffer = b""
+        self._buffer_start = 0
+        self._readahead = minimalReadahead
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError("Invalid whence ({})".format(whence))
+        if pos < 0:
+            raise ValueError("Negative seek position {}".format(pos))
+        self._pos = pos
+        return self._pos
+
+    def readinto(self, b):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        view = memoryview(b).cast('B')
+        # Short reads only happen at EOF, like with builtin open()
+        read = 0
+        while read < len(view) and self._pos < self._size:
+            read += self._read_buffered(view[read:])
+        return read
+
+    def _read_buffered(self, view):
+        length = min(len(view), self._size-self._pos)
+        buffer_end = self._buffer_start+len(self._buffer)
+        if not self._buffer_start <= self._pos < buffer_end:
+            if self._pos == buffer_end:
+                self._readahead = min(self._readahead*2, maximalReadahead)
+            else:
+                self._readahead = minimalReadahead
+            self._fill(self._pos, length, max(length, self._readahead))
+
+        offset = self._pos-self._buffer_start
+        length = min(length, len(self._buffer)-offset)
+        view[:length] = self._buffer[offset:offset+length]
+        self._pos += length
+        return length
+
+    def readall(self):
+        # Through readinto, so the block cache and the pinned revision apply
+        content = bytearray(max(self._size-self._pos, 0))
+        self.readinto(content)
+        return bytes(content)
+
+    def close(self):
+        self._buffer = b""
+        super().close()
+
+    def _fill(self, start, length, readahead):
+        end = min(start+readahead, self._size)
+        if self.cache:
+            self._fill_from_cache(start, start+length, end)
+            return
+        resp, self._buffer = self.drive_file._download_range(start, end-1)
+        self._buffer_start = start
+
+    def _fill_from_cache(self, start, needed_end, end):
+        # Whole blocks are fetched, consecutive misses in a single request.
+        # Readahead is only done if the requested range itself needs a fetch.
+        block_size = self.cache.block_size
+        first = start // block_size
+        last = (end-1) // block_size
+        needed_last = (needed_end-1) // block_size
+        blocks = [self.cache.get(self.drive_file.id, self._revision, index)
+                    for index in range(first, needed_last+1)]
+        if None in blocks:
+            blocks += [self.cache.get(self.drive_file.id, self._revision, index, count=False)
+                        for index in range(first+len(blocks), last+1)]
+        else:
+            last = first+len(blocks)-1
+        fetched = []
+        index = first
+        while index <= last:
+            if blocks[index-first] is not None:
+                index += 1
+                continue
+            missing_end = index
+            while missing_end <= last and blocks[missing_end-first] is None:
+                missing_end += 1
+            # Fetched from the revision the blocks are cached under, not
+            # from whatever the head is by now
+            resp, content = self.drive_file._download_range(index*block_size,
+                                min(missing_end*block_size, self._size)-1,
+                                self._revision or None)
+            for i in range(index, missing_end):
+                blocks[i-first] = content[(i-index)*block_size:(i-index+1)*block_size]
+                fetched.append(i)
+            index = missing_end
+        # Readahead blocks go in first so they are evicted before the
+        # blocks that were actually asked for
+        for i in sorted(fetched, key=lambda i: (i <= needed_last, i)):
+            self.cache.put(self.drive_file.id, self._revision, i, blocks[i-first])
+        self._buffer = b"".join(blocks)
+        self._buffer_start = first*block_size
+
+
+class DriveFileWriter(io.RawIOBase):
+    # Buffers writes and sends every full chunk to a StreamUploadRequest.
+    # close() sends the rest and fills in id and name of the DriveFile.
+    # Leaving a with block by an exception, or garbage collection without
+    # close(), abandons the upload instead.
+
+    def __init__(self, drive_file, chunksize=None):
+        if not chunksize:
+            chunksize = defaultChunksize
+        self.drive_file = drive_file
+        self.chunksize = -(-chunksize // minimalChunksize) * minimalChunksize
+        self._buffer = bytearray()
+        self._request = None
+        self._aborted = False
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        self._buffer += b
+        while len(self._buffer) >= self.chunksize:
+            self._send(bytes(self._buffer[:self.chunksize]))
+            del self._buffer[:self.chunksize]
+        return len(b)
+
+    def tell(self):
+        sent = self._request._resumable_progress if self._request else 0
+        return sent + len(self._buffer)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if not self._aborted:
+                self._finish()
+        finally:
+            self._buffer = bytearray()
+            super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._aborted = True
+        self.close()
+
+    def __del__(self):
+        # A writer that was never closed explicitly, e.g. because its
+        # producer crashed, must not publish what it got so far
+        self._aborted = True
+        super().__del__()
+
+    def _send(self, content, last=False):
+        if self._request is None:
+            self._request = StreamUploadRequest(self.drive_file.drive.service,
+                                    body=self.drive_file._upload_metadata(),
+                                    file_id=self.drive_file.id)
+        try:
+            status, response = self._request.send(content, last=last)
+        finally:
+            self.drive_file.upload_http_calls = self._request.http_calls
+        return response
+
+    def _finish(self):
+        if self._request is None and not self._buffer and not self.drive_file.id:
+            self.drive_file.upload_empty()
+            return
+        result = json.loads(self._send(bytes(self._buffer), last=True))
+        self.drive_file._set_uploaded(result, self._request._resumable_progress)
+
+
+class BlockCache:
+    # Fixed-size blocks of remote files stored as
+    # <directory>/<file id>/<revision>/<block index>, evicted in LRU order
+    # once max_bytes is exceeded. The order survives restarts via mtime.
+
+    def __init__(self, directory, max_bytes, block_size=defaultChunksize):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()
+        self._size = 0
+
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if filename.endswith('.tmp'):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, path, stat.st_size))
+        for mtime, path, size in sorted(entries):
+            self._blocks[path] = size
+            self._size += size
+        with self._lock:
+            self._evict()
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, file_id, revision, index, count=True):
+        # count=False for readahead probes, which would skew hits and misses
+        path = self._path(file_id, revision, index)
+        with self._lock:
+            if path not in self._blocks:
+                if count:
+                    self.misses += 1
+                return None
+            if count:
+                self.hits += 1
+            self._blocks.move_to_end(path)
+        try:
+            os.utime(path)
+            with open(path, 'rb') as fh:
+                return fh.read()
+        except FileNotFoundError:
+            with self._lock:
+                self._forget(path)
+            return None
+
+    def put(self, file_id, revision, index, content):
+        path = self._path(file_id, revision, index)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path+'.tmp', 'wb') as fh:
+            fh.write(content)
+        os.replace(path+'.tmp', path)
+        with self._lock:
+            self._forget(path)
+            self._blocks[path] = len(content)
+            self._size += len(content)
+            self._evict()
+
+    def _path(self, file_id, revision, index):
+        return os.path.join(self.directory, file_id, revision or 'none', str(index))
+
+    def _forget(self, path):
+        self._size -= self._blocks.pop(path, 0)
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._blocks:
+            path, size = self._blocks.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class DownloadCache:
+    # Completed downloads stored as <directory>/<md5[:2]>/<md5>. Entries are
+    # written atomically and made read-only. Hits are placed as reflink or
+    # copy. With hardlink=True they share the inode of the cache entry
+    # instead, so the downloaded files must then be treated as read-only:
+    # writing to one corrupts the cache. Eviction removes the oldest mtime
+    # first and holds a lock file so several processes can share the same
+    # directory.
+
+    def __init__(self, directory, max_bytes, hardlink=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hardlink = hardlink
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def fetch(self, md5sum, local_file) -> bool:
+        path = self._path(md5sum)
+        tmp_file = "{}.{}.tmp".format(local_file, uuid.uuid4().hex)
+        try:
+            self._place(path, tmp_file)
+            os.utime(path)
+        except FileNotFoundError:
+            # The entry may have been evicted right after it was placed
+            try:
+                os.remove(tmp_file)
+            except FileNotFoundError:
+                pass
+            self.misses += 1
+            return False
+        os.replace(tmp_file, local_file)
+        self.hits += 1
+        return True
+
+    def store(self, md5sum, local_file):
+        path = self._path(md5sum)
+        if os.path.exists(path):
+            os.utime(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_file = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        try:
+            self._clone(local_file, tmp_file)
+        except OSError:
+            shutil.copyfile(local_file, tmp_file)
+        os.chmod(tmp_file, 0o444)
+        os.replace(tmp_file, path)
+        self.evict()
+
+    def evict(self):
+        with _FileLock(os.path.join(self.directory, '.lock')):
+            entries = []
+            for dirpath, dirnames, filenames in os.walk(self.directory):
+                for filename in filenames:
+                    if filename == '.lock' or filename.endswith('.tmp'):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, path, stat.st_size))
+            size = sum(entry[2] for entry in entries)
+            for mtime, path, entry_size in sorted(entries):
+                if size <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                size -= entry_size
+
+    def _path(self, md5sum):
+        return os.path.join(self.directory, md5sum[:2], md5sum)
+
+    def _place(self, path, local_file):
+        if self.hardlink:
+            try:
+                os.link(path, local_file)
+                return
+            except FileNotFoundError:
+                raise
+            except OSError:
+                pass
+        try:
+            self._clone(path, local_file)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            shutil.copyfile(path, local_file)
+
+    @staticmethod
+    def _clone(src, dst):
+        # Reflink copy (FICLONE), only supported on Linux by some filesystems
+        if fcntl is None:
+            raise OSError("Reflinks not supported")
+        with open(src, 'rb') as src_fh, open(dst, 'wb') as dst_fh:
+            try:
+                fcntl.ioctl(dst_fh.fileno(), 0x40049409, src_fh.fileno())
+            except OSError:
+                dst_fh.close()
+                os.remove(dst)
+                raise
+
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self._fh = open(self.path, 'a')
+        if fcntl:
+            fcntl.flock(self._fh, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl:
+            fcntl.flock(self._fh, fcntl.LOCK_UN)
+        self._fh.close()
+
+
+class PackStore:
+    # Many small files stored together in pack files in a folder, to save
+    # the API calls of one upload each. A pack ends with a JSON index of its
+    # members, whose offset is kept in the drivelibPackIndex appProperty.
+    # index maps member names to (pack id, offset, length, md5), and a
+    # member is read with a single ranged GET. Members added again later
+    # replace older ones.
+
+    def __init__(self, folder, pack_size=defaultPackSize, tmp_dir=None, index=None):
+        # index can be any mapping, e.g. a ChunkIndex to keep it on disk
+        self.folder = folder
+        self.pack_size = pack_size
+        self.tmp_dir = tmp_dir
+        self.index = {} if index is None else index
+        self._pending = {}
+        self._spool = None
+        self._spool_path = None
+        self._spool_size = 0
+
+    def load(self):
+        # One listing and one ranged GET per pack
+        self.index.clear()
+        query = "'{}' in parents and trashed = false".format(self.folder.id)
+        fields = self.folder.drive.default_fields + ", size, appProperties"
+        for pack in self.folder.drive.items_by_query(query, pageSize=1000, orderBy='createdTime',
+                                    spaces=self.folder.spaces, fields=fields):
+            if pack.isfolder() or 'drivelibPackIndex' not in (pack.app_properties or {}):
+                continue
+            index_offset = int(pack.app_properties['drivelibPackIndex'])
+            resp, content = pack._download_range(index_offset, pack.size-1)
+            for name, (offset, length, md5) in json.loads(content).items():
+                self.index[name] = (pack.id, offset, length, md5)
+
+    def add(self, name, data):
+        if self._spool is None:
+            fd, self._spool_path = tempfile.mkstemp(suffix='.pack', dir=self.tmp_dir)
+            self._spool = os.fdopen(fd, 'wb')
+            self._spool_size = 0
+        self._spool.write(data)
+        self._pending[name] = (self._spool_size, len(data), hashlib.md5(data).hexdigest())
+        self._spool_size += len(data)
+        if self._spool_size >= self.pack_size:
+            self.flush()
+
+    def add_file(self, name, local_file):
+        with open(local_file, 'rb') as fh:
+            self.add(name, fh.read())
+
+    def flush(self):
+        if self._spool is None:
+            return
+        try:
+            self._spool.write(json.dumps(self._pending).encode())
+            self._spool.close()
+            pack = self.folder.new_file("{}.pack".format(uuid.uuid4().hex))
+            pack.upload(self._spool_path,
+                        app_properties={'drivelibPackIndex': str(self._spool_size)})
+            for name, (offset, length, md5) in self._pending.items():
+                self.index[name] = (pack.id, offset, length, md5)
+        finally:
+            # Members of a failed pack are dropped, they are not stored
+            self._discard_spool()
+
+    def _discard_spool(self):
+        self._spool.close()
+        os.remove(self._spool_path)
+        self._spool = None
+        self._spool_size = 0
+        self._pending = {}
+
+    def read(self, name) -> bytes:
+        if name in self._pending:
+            self.flush()
+        pack_id, offset, length, md5 = self.index[name]
+        if length == 0:
+            return b""
+        pack = DriveFile(self.folder.drive, [self.folder.id], None, pack_id)
+        resp, content = pack._download_range(offset, offset+length-1)
+        if hashlib.md5(content).hexdigest() != md5:
+            raise CheckSumError("Checksum mismatch of {}.".format(name))
+        return content
+
+    def __contains__(self, name):
+        return name in self.index or name in self._pending
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._spool is not None:
+            self._discard_spool()
+
+
+class ChunkIndex(MutableMapping):
+    # PackStore index kept in a SQLite database
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS chunks (
+                                name TEXT PRIMARY KEY,
+                                pack_id TEXT NOT NULL,
+                                offset INTEGER NOT NULL,
+                                length INTEGER NOT NULL,
+                                md5 TEXT NOT NULL)""")
+
+    def __getitem__(self, name):
+        with self._lock:
+            row = self._db.execute("SELECT pack_id, offset, length, md5 FROM chunks WHERE name=?",
+                                    (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return row
+
+    def __setitem__(self, name, entry):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?)",
+                                (name,) + tuple(entry))
+
+    def __delitem__(self, name):
+        with self._lock, self._db:
+            if self._db.execute("DELETE FROM chunks WHERE name=?", (name,)).rowcount == 0:
+                raise KeyError(name)
+
+    def __contains__(self, name):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM chunks WHERE name=?", (name,)).fetchone() is not None
+
+    def __iter__(self):
+        with self._lock:
+            names = [row[0] for row in self._db.execute("SELECT name FROM chunks")]
+        return iter(names)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM chunks")
+
+    def close(self):
+        self._db.close()
+
+
+# Random but fixed values per byte, so chunk boundaries stay the same
+# between runs
+_gear = [int.from_bytes(hashlib.md5(bytes([i])).digest()[:8], 'big') for i in range(256)]
+
+
+def _cdc_chunks(fh, min_size, avg_size, max_size):
+    # Content-defined chunking with a gear rolling hash: a chunk ends where
+    # the top bits of the hash are zero, at least min_size and at most
+    # max_size bytes in. Inserting bytes only moves the boundaries around
+    # the change.
+    bits = max((avg_size-min_size).bit_length()-1, 1)
+    mask = ((1 << bits) - 1) << (64 - bits)
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < max_size:
+            data = fh.read(max_size)
+            if not data:
+                eof = True
+            buffer += data
+        if not buffer:
+            return
+        end = min(len(buffer), max_size)
+        cut = end
+        hash_ = 0
+        # Locals only, this loop runs once per byte
+        gear = _gear
+        for i, byte in enumerate(itertools.islice(buffer, min_size, end), min_size+1):
+            hash_ = ((hash_ << 1) + gear[byte]) & 0xFFFFFFFFFFFFFFFF
+            if not hash_ & mask:
+                cut = i
+                break
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+
+def _file_chunks(fh, min_size, avg_size, max_size):
+    # The Python loop above manages a few MB/s, so use the native FastCDC
+    # of the fastcdc package when it is installed. It mmaps the file, which
+    # fails for empty files. Boundaries differ between the two, so mixing
+    # them in one store only costs deduplication, not correctness.
+    if fastcdc_cy is not None and os.fstat(fh.fileno()).st_size:
+        for chunk in fastcdc_cy(fh, min_size, avg_size, max_size, fat=True):
+            yield chunk.data
+    else:
+        yield from _cdc_chunks(fh, min_size, avg_size, max_size)
+
+
+class DedupStore:
+    # Deduplicating backup store in a folder. Files are split into
+    # content-defined chunks named by their SHA-256, and only chunks not
+    # stored yet are uploaded, grouped into packs (PackStore in "chunks").
+    # Each snapshot is a JSON manifest of chunks in "snapshots". The local
+    # ChunkIndex answers presence checks without API calls and is rebuilt
+    # from the packs if it is empty.
+
+    def __init__(self, folder, index_path, pack_size=defaultPackSize,
+                    min_chunk=minimalDedupChunk, avg_chunk=averageDedupChunk,
+                    max_chunk=maximalDedupChunk):
+        self.folder = folder
+        self.min_chunk = min_chunk
+        self.avg_chunk = avg_chunk
+        self.max_chunk = max_chunk
+        self.index = ChunkIndex(index_path)
+        self.packs = PackStore(folder.mkdir("chunks"), pack_size=pack_size, index=self.index)
+        self.snapshot_folder = folder.mkdir("snapshots")
+        if not len(self.index):
+            self.packs.load()
+
+    def backup(self, local_file, snapshot) -> dict:
+        #TODO: Accept Path objects for local_file
+        chunks = []
+        stats = {'chunks': 0, 'new_chunks': 0, 'bytes': 0, 'new_bytes': 0}
+        with open(local_file, 'rb') as fh:
+            for chunk in _file_chunks(fh, self.min_chunk, self.avg_chunk, self.max_chunk):
+                name = hashlib.sha256(chunk).hexdigest()
+                if name not in self.packs:
+                    self.packs.add(name, chunk)
+                    stats['new_chunks'] += 1
+                    stats['new_bytes'] += len(chunk)
+                chunks.append((name, len(chunk)))
+                stats['chunks'] += 1
+                stats['bytes'] += len(chunk)
+        self.packs.flush()
+
+        manifest = {'size': stats['bytes'], 'chunks': chunks}
+        try:
+            manifest_file = self.snapshot_folder.child(snapshot + ".json")
+        except FileNotFoundError:
+            manifest_file = self.snapshot_folder.new_file(snapshot + ".json")
+        manifest_file.upload_stream(iter([json.dumps(manifest).encode()]))
+        return stats
+
+    def snapshots(self) -> list:
+        return sorted(item.name[:-len(".json")] for item in self.snapshot_folder.children(folders=False)
+                        if item.name.endswith(".json"))
+
+    def restore(self, snapshot, local_file, workers=4):
+        # Chunks are fetched concurrently and written at their offset
+        manifest = json.loads(b"".join(self.snapshot_folder.child(snapshot + ".json").iter_content()))
+        write_lock = threading.Lock()
+        tmp_file = "{}.{}.tmp".format(local_file, uuid.uuid4().hex)
+
+        def fetch(name, offset):
+            content = self.packs.read(name)
+            if hashlib.sha256(content).hexdigest() != name:
+                raise CheckSumError("Checksum mismatch of chunk {}.".format(name))
+            with write_lock:
+                fh.seek(offset)
+                fh.write(content)
+
+        try:
+            with open(tmp_file, 'wb') as fh:
+                fh.truncate(manifest['size'])
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = []
+                    offset = 0
+                    for name, length in manifest['chunks']:
+                        futures.append(executor.submit(fetch, name, offset))
+                        offset += length
+                    try:
+                        for future in as_completed(futures):
+                            future.result()
+                    except BaseException:
+                        for future in futures:
+                            future.cancel()
+                        raise
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+        os.replace(tmp_file, local_file)
+
+    def close(self):
+        self.packs.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class UploadJournal:
+    # Unfinished resumable uploads in a SQLite database, keyed by local path
+    # and target (parent id and name), so a restarted process can pick them
+    # up again with resume_all().
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS uploads (
+                                local_path TEXT NOT NULL,
+                                parent_id TEXT NOT NULL,
+                                name TEXT NOT NULL,
+                                resumable_uri TEXT NOT NULL,
+                                progress INTEGER NOT NULL,
+                                checkpoint TEXT,
+                                created REAL NOT NULL,
+                                PRIMARY KEY (local_path, parent_id, name))""")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS hashes (
+                                local_path TEXT PRIMARY KEY,
+                                size INTEGER NOT NULL,
+                                mtime_ns INTEGER NOT NULL,
+                                md5 TEXT NOT NULL)""")
+
+    @staticmethod
+    def _key(local_file, drive_file):
+        parent_id = drive_file.parent_ids[0] if drive_file.parent_ids else ''
+        return os.path.abspath(local_file), parent_id, drive_file.name
+
+    def lookup(self, local_file, drive_file):
+        # Returns (resumable_uri, checkpoint) or None
+        self.expire()
+        with self._lock:
+            row = self._db.execute("""SELECT resumable_uri, checkpoint FROM uploads
+                                WHERE local_path=? AND parent_id=? AND name=?""",
+                                self._key(local_file, drive_file)).fetchone()
+        return row
+
+    def record(self, local_file, drive_file, resumable_uri, progress, checkpoint=None):
+        # Keeps the creation time of an existing entry for the same session
+        with self._lock, self._db:
+            self._db.execute("""INSERT INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?)
+                                ON CONFLICT (local_path, parent_id, name) DO UPDATE SET
+                                    created = CASE WHEN resumable_uri = excluded.resumable_uri
+                                                THEN created ELSE excluded.created END,
+                                    resumable_uri = excluded.resumable_uri,
+                                    progress = excluded.progress,
+                                    checkpoint = excluded.checkpoint""",
+                                self._key(local_file, drive_file)
+                                    + (resumable_uri, progress, checkpoint, time.time()))
+
+    def local_md5(self, local_file):
+        # MD5 of a local file, only computed again if size or mtime changed
+        local_path = os.path.abspath(local_file)
+        stat = os.stat(local_path)
+        with self._lock:
+            row = self._db.execute("SELECT size, mtime_ns, md5 FROM hashes WHERE local_path=?",
+                                    (local_path,)).fetchone()
+        if row and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            return row[2]
+        md5 = DriveFile._file_md5(local_path)
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)",
+                                (local_path, stat.st_size, stat.st_mtime_ns, md5))
+        return md5
+
+    def remove(self, local_file, drive_file):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM uploads WHERE local_path=? AND parent_id=? AND name=?",
+                                self._key(local_file, drive_file))
+
+    def expire(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM uploads WHERE created < ?",
+                                (time.time() - sessionLifetime,))
+
+    def pending(self):
+        # Returns (local_path, parent_id, name, progress) of all unfinished uploads
+        self.expire()
+        with self._lock:
+            return self._db.execute("""SELECT local_path, parent_id, name, progress
+                                FROM uploads ORDER BY created""").fetchall()
+
+    def resume_all(self, drive, **kwargs):
+        # Finishes every upload in the journal. Uploads whose local file has
+        # gone are dropped, ones whose local file changed start over.
+        uploaded = {}
+        for local_path, parent_id, name, progress in self.pending():
+            drive_file = DriveFile(drive, [parent_id] if parent_id else [], name)
+            if not os.path.exists(local_path):
+                self.remove(local_path, drive_file)
+                continue
+            try:
+                drive_file.upload(local_path, journal=self, **kwargs)
+            except CheckSumError:
+                drive_file.upload(local_path, journal=self, **kwargs)
+            uploaded[local_path] = drive_file
+        return uploaded
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class UploadSessionPool:
+    # Resumable upload sessions opened in the background for files queued
+    # with prepare(), so their upload can start with the first data request.
+    # Sessions are matched by target (parents, name and appProperties) and
+    # dropped if not taken within max_age.
+
+    def __init__(self, drive, workers=4, max_age=sessionLifetime/2):
+        self.drive = drive
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(drive_file, app_properties):
+        return tuple(drive_file.parent_ids), drive_file.name, \
+                tuple(sorted((app_properties or {}).items()))
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def prepare(self, drive_file, app_properties=None):
+        # The metadata of a session is fixed when it is created, so
+        # app_properties have to be given here and to the upload
+        body = drive_file._upload_metadata(app_properties)
+        future = self._executor.submit(self._create_session, body)
+        with self._lock:
+            self._sessions.setdefault(self._key(drive_file, app_properties), []).append((time.time(), future))
+
+    def _create_session(self, body):
+        # drive.service is per thread
+        return ResumableUploadRequest.create_session(self.drive.service._http.request, body)
+
+    def take(self, drive_file, app_properties=None):
+        # Returns an unused session URI for drive_file or None. Waits if
+        # the session is still being created.
+        self.expire()
+        key = self._key(drive_file, app_properties)
+        with self._lock:
+            entries = self._sessions.get(key)
+            future = entries.pop(0)[1] if entries else None
+            if entries == []:
+                del self._sessions[key]
+        try:
+            resumable_uri = future.result() if future else None
+        except Exception as e:
+            logger.warning("Could not create upload session for %s: %s", drive_file.name, e)
+            resumable_uri = None
+        with self._lock:
+            if resumable_uri:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return resumable_uri
+
+    def expire(self):
+        deadline = time.time() - self.max_age
+        with self._lock:
+            for key in list(self._sessions):
+                entries = self._sessions[key]
+                for created, future in entries:
+                    if created < deadline:
+                        future.cancel()
+                        self.expired += 1
+                entries[:] = [entry for entry in entries if entry[0] >= deadline]
+                if not entries:
+                    del self._sessions[key]
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        with self._lock:
+            for entries in self._sessions.values():
+                for created, future in entries:
+                    future.cancel()
+            self._sessions.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MmapMediaUpload(MediaUpload):
+    # Memory-maps the file and hands out memoryview slices, so a chunk is
+    # read from disk once by the page cache and passed to both the hasher
+    # and the HTTP body without being copied. ACCESS_COPY gives writable
+    # views, which ResumableMD5 can hash in place, without ever writing
+    # back to the file.
+
+    def __init__(self, filename, mimetype='application/octet-stream',
+                    chunksize=defaultChunksize, offset=0, length=None):
+        # offset and length select a section of the file to upload
+        self._filename = filename
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        with open(filename, 'rb') as fh:
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_COPY)
+        if length is None:
+            self._view = memoryview(self._mmap)[offset:]
+        else:
+            self._view = memoryview(self._mmap)[offset:offset+length]
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return len(self._view)
+
+    def resumable(self):
+        return True
+
+    def getbytes(self, begin, length):
+        return self._view[begin:begin+length]
+
+    def has_stream(self):
+        return False
+
+    def close(self):
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # A slice is still referenced, the map is closed once it is gone
+            pass
+
+    def to_json(self):
+        raise NotImplementedError("MmapMediaUpload can not be serialized")
+
+
 class ResumableUploadRequest:
     # TODO: actually implement interface for http_request
     # TODO: error handling
-    def __init__(self, service, media_body, body, upload_id=None):
+    def __init__(self, service, media_body, body, upload_id=None,
+                    md5_state=None, prefetch=0, file_id=None):
         self.service = service
         self.media_body = media_body
         self.body = body
+        # Uploads a new revision of this file instead of creating one
+        self.file_id = file_id
         self.upload_id=upload_id
+        # base64 ResumableMD5 state of the confirmed prefix
+        self.md5_state = md5_state
+        # Number of chunks read and hashed ahead in a background thread
+        # while the current one is being sent
+        self.prefetch = prefetch
         self._resumable_progress = None
         self._resumable_uri = None
         self._range_md5 = None
+        self._prefetched = None
+        self._prefetch_thread = None
+        self._prefetch_stop = threading.Event()
+        # Set if the status request found the upload already finished
+        self._completed_response = None
+        self.http_calls = 0
+
+    def _request(self, uri, **kwargs):
+        self.http_calls += 1
+        return self.service._http.request(uri, **kwargs)
 
     @property
     def upload_id(self):
@@ -421,29 +2574,48 @@ class ResumableUploadRequest:
     @property
     def resumable_uri(self):
         if self._resumable_uri is None:
-            api_url = "https://www.googleapis.com/upload/drive/v3/files?uploadType=resumable" 
-            status, resp = self.service._http.request(api_url, method='POST', headers={'Content-Type':'application/json; charset=UTF-8'}, body=json.dumps(self.body)) 
-            if status['status'] != '200':
-                raise HttpError(status, resp)
-            self._resumable_uri = status['location']
+            self._resumable_uri = self.create_session(self._request, self.body, self.file_id)
         return self._resumable_uri
         
     @resumable_uri.setter
     def resumable_uri(self, resumable_uri):
         self._resumable_uri = resumable_uri
+
+    @staticmethod
+    def create_session(http_request, body, file_id=None):
+        # The final response then contains the checksum as well
+        if file_id:
+            api_url = "https://www.googleapis.com/upload/drive/v3/files/{}?uploadType=resumable&fields=id,name,md5Checksum".format(file_id)
+            method = 'PATCH'
+        else:
+            api_url = "https://www.googleapis.com/upload/drive/v3/files?uploadType=resumable&fields=id,name,md5Checksum"
+            method = 'POST'
+        status, resp = http_request(api_url, method=method, headers={'Content-Type':'application/json; charset=UTF-8'}, body=json.dumps(body))
+        if status['status'] != '200':
+            raise HttpError(status, resp)
+        return status['location']
+
+    def use_new_session(self, resumable_uri):
+        # Nothing can have been uploaded to a session nobody used yet,
+        # so no status request is needed
+        self._resumable_uri = resumable_uri
+        self.md5_state = None
+        self._resumable_progress = 0
+        self._range_md5, hashed = self._restore_md5(0)
         
             
     @property
     def resumable_progress(self):
+        if self._resumable_progress is None and self._resumable_uri is None:
+            self.use_new_session(self.resumable_uri)
         if self._resumable_progress is None:
             upload_range = "bytes */{}".format(self.media_body.size())
-            status, resp = self.service._http.request(self.resumable_uri, method='PUT', headers={'Content-Length':'0', 'Content-Range':upload_range})
+            status, resp = self._request(self.resumable_uri, method='PUT', headers={'Content-Length':'0', 'Content-Range':upload_range})
             
             if status['status'] not in ('200', '308'):
                 #Should 404 result in a FileNotFound error?
                 raise HttpError(status, resp)
 
-            self._range_md5 = hashlib.md5()
             def file_in_chunks(start_byte: int, end_byte: int, chunksize: int = 4*1024**2):
                 while start_byte < end_byte:
                     content_length = min(chunksize, end_byte-start_byte)
@@ -452,13 +2624,16 @@ class ResumableUploadRequest:
 
             if status['status'] == '200':
                 self._resumable_progress = self.media_body.size()
+                self._completed_response = resp
 
-                for chunk in file_in_chunks(0, self._resumable_progress):
+                self._range_md5, hashed = self._restore_md5(self._resumable_progress)
+                for chunk in file_in_chunks(hashed, self._resumable_progress):
                     self._range_md5.update(chunk)
             elif 'range' in status.keys():
                 self._resumable_progress = int(status['range'].replace('bytes=0-', '', 1))+1
 
-                for chunk in file_in_chunks(0, self._resumable_progress):
+                self._range_md5, hashed = self._restore_md5(self._resumable_progress)
+                for chunk in file_in_chunks(hashed, self._resumable_progress):
                     self._range_md5.update(chunk)
                 logger.debug("Local MD5 (0-%d): %s", self._resumable_progress, self._range_md5.hexdigest())
                 logger.debug("Remote MD5 (0-%d): %s", self._resumable_progress, status['x-range-md5'])
@@ -467,6 +2642,7 @@ class ResumableUploadRequest:
 
             else:
                 self._resumable_progress = 0
+                self._range_md5, hashed = self._restore_md5(0)
 
         return self._resumable_progress
 
@@ -474,36 +2650,156 @@ class ResumableUploadRequest:
     def resumable_progress(self, resumable_progress):
         self._resumable_progress = resumable_progress
 
+    def _restore_md5(self, resumable_progress):
+        # Continue from the checkpoint if it does not reach beyond what the
+        # server has, so only the bytes after it need to be read again
+        if self.md5_state and ResumableMD5.supported():
+            range_md5 = ResumableMD5(base64.b64decode(self.md5_state))
+            if range_md5.length <= resumable_progress:
+                return range_md5, range_md5.length
+        if ResumableMD5.supported():
+            return ResumableMD5(), 0
+        return hashlib.md5(), 0
+
+    def _update_checkpoint(self):
+        if isinstance(self._range_md5, ResumableMD5):
+            self.md5_state = base64.b64encode(self._range_md5.state()).decode()
+
+    def _verify_upload(self, resp, lookup=False):
+        # The response to the final chunk carries md5Checksum if the session
+        # was created with fields. A session that turned out to be finished
+        # before is looked up to tell whether the file still exists.
+        result = json.loads(resp)
+        if not lookup and 'md5Checksum' in result:
+            remote_md5 = result['md5Checksum']
+        else:
+            try:
+                self.http_calls += 1
+                remote_md5 = self.service.files().get(fileId=result['id'], fields="md5Checksum").execute()['md5Checksum']
+            except HttpError as e:
+                if e.resp.status == 404:
+                    raise FileNotFoundError("File was successfully uploaded but since has been deleted")
+                else:
+                    raise
+        logger.debug("Remote MD5 (0-%d): %s", self.resumable_progress, remote_md5)
+        if remote_md5 != self._range_md5.hexdigest():
+            raise CheckSumError("Final checksum mismatch. Need to repeat upload.")
+
+    def _prefetch_chunks(self, start_byte, range_md5):
+        # Runs in the background, hands out (start, content, md5 up to the
+        # end of this chunk) so next_chunk only has to send
+        try:
+            while start_byte < self.media_body.size():
+                content_length = min(self.media_body.size()-start_byte, self.media_body.chunksize())
+                content = self.media_body.getbytes(start_byte, content_length)
+                range_md5 = range_md5.copy()
+                range_md5.update(content)
+                item = (start_byte, content, range_md5)
+                start_byte += content_length
+                while not self._prefetch_stop.is_set():
+                    try:
+                        self._prefetched.put(item, timeout=.1)
+                        break
+                    except queue.Full:
+                        pass
+                else:
+                    return
+        except Exception as e:
+            if not self._prefetch_stop.is_set():
+                self._prefetched.put((None, e, None))
+
+    def _next_prefetched(self):
+        if self._prefetched is None:
+            self._prefetched = queue.Queue(maxsize=self.prefetch)
+            self._prefetch_thread = threading.Thread(target=self._prefetch_chunks,
+                                args=(self.resumable_progress, self._range_md5),
+                                daemon=True)
+            self._prefetch_thread.start()
+        start_byte, content, range_md5 = self._prefetched.get()
+        if start_byte is None:
+            raise content
+        if start_byte != self.resumable_progress:
+            raise ValueError("Prefetched chunk at {} but upload is at {}".format(
+                                start_byte, self.resumable_progress))
+        return content, range_md5
+
+    def close(self):
+        # Wait for the prefetch thread, it may still be reading media_body
+        self._prefetch_stop.set()
+        if self._prefetch_thread:
+            self._prefetch_thread.join()
+
     def next_chunk(self):
         content_length = min(self.media_body.size()-self.resumable_progress, self.media_body.chunksize()) 
         upload_range = "bytes {}-{}/{}".format(self.resumable_progress, self.resumable_progress+content_length-1, self.media_body.size()) 
-        content = self.media_body.getbytes(self.resumable_progress, content_length)
-        status, resp = self.service._http.request(self.resumable_uri, method='PUT', headers={'Content-Length':str(content_length), 'Content-Range':upload_range}, body=content)
+        if self._completed_response is not None:
+            self._verify_upload(self._completed_response, lookup=True)
+            return ResumableMediaUploadProgress(self.resumable_progress, self.media_body.size(),
+                                    self.resumable_uri, http_calls=self.http_calls), self._completed_response
+        if self.prefetch:
+            content, range_md5 = self._next_prefetched()
+        else:
+            content = self.media_body.getbytes(self.resumable_progress, content_length)
+            range_md5 = None
+        status, resp = self._request(self.resumable_uri, method='PUT', headers={'Content-Length':str(content_length), 'Content-Range':upload_range}, body=content)
         if status['status'] in ('200', '308'):
-            self._range_md5.update(content)
+            if range_md5:
+                self._range_md5 = range_md5
+            else:
+                self._range_md5.update(content)
             logger.debug("Local MD5 (0-%d): %s", self.resumable_progress+content_length, self._range_md5.hexdigest())
             if status['status'] == '308':
                 logger.debug("Remote MD5 (0-%d): %s", self.resumable_progress+content_length, status['x-range-md5'])
                 if status['x-range-md5'] != self._range_md5.hexdigest():
                     raise CheckSumError("Checksum mismatch. Need to repeat upload.")
                 self.resumable_progress += content_length
+                self._update_checkpoint()
             elif status['status'] == '200':
                 self.resumable_progress = self.media_body.size()
-                result = json.loads(resp)
-                try:
-                    remote_md5 = self.service.files().get(fileId=result['id'], fields="md5Checksum").execute()['md5Checksum']
-                except HttpError as e:
-                    if e.resp.status == 404:
-                        raise FileNotFoundError("File was successfully uploaded but since has been deleted")
-                    else:
-                        raise
-                logger.debug("Remote MD5 (0-%d): %s", self.resumable_progress, remote_md5)
-                if remote_md5 != self._range_md5.hexdigest():
-                    raise CheckSumError("Final checksum mismatch. Need to repeat upload.")
+                self._verify_upload(resp)
         else:
             raise HttpError(status, resp)
             
-        return ResumableMediaUploadProgress(self.resumable_progress, self.media_body.size(), self.resumable_uri), resp
+        return ResumableMediaUploadProgress(self.resumable_progress, self.media_body.size(),
+                                            self.resumable_uri, http_calls=self.http_calls), resp
+
+
+class StreamUploadRequest(ResumableUploadRequest):
+    # Upload of content with unknown total size. Chunks are sent as
+    # "bytes a-b/*" and must be multiples of minimalChunksize, only the
+    # last one states the total size.
+
+    def __init__(self, service, body, file_id=None):
+        super().__init__(service, media_body=None, body=body, file_id=file_id)
+        self._resumable_progress = 0
+        self._range_md5 = hashlib.md5()
+
+    def send(self, content, last=False):
+        start_byte = self._resumable_progress
+        end_byte = start_byte+len(content)
+        total_size = end_byte if last else '*'
+        if content:
+            upload_range = "bytes {}-{}/{}".format(start_byte, end_byte-1, total_size)
+        else:
+            upload_range = "bytes */{}".format(total_size)
+        status, resp = self._request(self.resumable_uri, method='PUT', headers={'Content-Length':str(len(content)), 'Content-Range':upload_range}, body=content)
+        if status['status'] == '308':
+            self._range_md5.update(content)
+            logger.debug("Remote MD5 (0-%d): %s", end_byte, status.get('x-range-md5'))
+            # A missing header counts as a mismatch, like in next_chunk
+            if status.get('x-range-md5') != self._range_md5.hexdigest():
+                raise CheckSumError("Checksum mismatch. Need to repeat upload.")
+            self._resumable_progress = end_byte
+        elif status['status'] == '200':
+            self._range_md5.update(content)
+            self._resumable_progress = end_byte
+            self._verify_upload(resp)
+        else:
+            raise HttpError(status, resp)
+
+        return ResumableMediaUploadProgress(self._resumable_progress,
+                                    end_byte if last else None, self.resumable_uri,
+                                    http_calls=self.http_calls), resp
 
 
 class GoogleDrive(DriveFolder):
@@ -533,12 +2829,7 @@ class GoogleDrive(DriveFolder):
                 and autorefresh:
             self.creds.refresh(Request())
 
-        http = google_auth_httplib2.AuthorizedHttp(self.creds)
-
-        #see bug https://github.com/googleapis/google-api-python-client/issues/803#issuecomment-578151576
-        http.http.redirect_codes = set(http.http.redirect_codes) - {308}
-
-        self._service = build('drive', 'v3', http=http)
+        self._thread_local = threading.local()
 
         self.id = None
         self.drive = self
@@ -553,20 +2844,41 @@ class GoogleDrive(DriveFolder):
         #self.caching = caching
         #TODO: Add caching ability
 
+    def _build_service(self):
+        http = google_auth_httplib2.AuthorizedHttp(self.creds)
+
+        #see bug https://github.com/googleapis/google-api-python-client/issues/803#issuecomment-578151576
+        http.http.redirect_codes = set(http.http.redirect_codes) - {308}
+
+        return build('drive', 'v3', http=http)
+
     @property
     def service(self):
-        return self._service
+        # httplib2.Http is not thread-safe, so every thread gets its own
+        if not hasattr(self._thread_local, 'service'):
+            self._thread_local.service = self._build_service()
+        return self._thread_local.service
+
+    def _build_session(self):
+        return AuthorizedSession(self.creds)
+
+    @property
+    def session(self):
+        # requests session for streamed transfers, one per thread as well
+        if not hasattr(self._thread_local, 'session'):
+            self._thread_local.session = self._build_session()
+        return self._thread_local.session
 
     def json_creds(self):
         return Credentials.to_json(self.creds)
 
-    def items_by_query(self, query, pageSize=100, orderBy=None, spaces='drive'):
+    def items_by_query(self, query, pageSize=100, orderBy=None, spaces='drive', fields=None):
         result = {'nextPageToken': ''}
         while "nextPageToken" in result:
             result = self.service.files().list(
                     pageSize=pageSize,
                     spaces=spaces,
-                    fields="nextPageToken, files({})".format(self.default_fields),
+                    fields="nextPageToken, files({})".format(fields or self.default_fields),
                     q=query,
                     pageToken=result['nextPageToken'],
                     orderBy=orderBy,
@@ -51,6 +51,8 @@ setup(
 
     extras_require={
         'test': ['coverage'],
+        'zstd': ['zstandard'],
+        'fastcdc': ['fastcdc'],
     },
     install_requires=[
         'google-api-python-client',
@@ -58,5 +60,6 @@ setup(
         'google-auth-httplib2',
         'google-auth',
         'oauth2client',
+        'requests',
       ],
 )
@@ -4,6 +4,7 @@ import random
 import os
 from pathlib import Path
 import shutil
+import io
 from hashlib import md5
 
 from drivelib import Credentials
@@ -11,8 +12,18 @@ from drivelib import GoogleDrive
 from drivelib import DriveFile
 from drivelib import DriveFolder
 from drivelib import ResumableMediaUploadProgress
+from drivelib import BlockCache
+from drivelib import DownloadCache
+from drivelib import UploadJournal
+from drivelib import UploadSessionPool
+from drivelib import PackStore
+from drivelib import DedupStore
+from drivelib import ResumableMD5
+from drivelib import checkpointSuffix
+from drivelib import minimalReadahead
 
 from drivelib import CheckSumError
+from drivelib import RemoteFileChangedError
 from drivelib import HttpError
 
 
@@ -279,6 +290,69 @@ class TestDriveFolder:
         folder = remote_tmpdir.create_path("./1/2a/../2b/")
         assert folder == remote_tmpdir.child_from_path("1/2b")
 
+    def test_download_tree(self, tmp_path: Path, remote_tmp_subdir: DriveFolder, remote_tmpfile):
+        remote_files = [remote_tmpfile(size_bytes=1024, subdir=remote_tmp_subdir)]
+        subdir = remote_tmp_subdir.create_path("a/b")
+        remote_files.append(remote_tmpfile(size_bytes=1024, subdir=subdir))
+
+        local_dir = tmp_path / "tree"
+        manifest = remote_tmp_subdir.download_tree(str(local_dir), workers=2)
+        assert md5_file(local_dir / remote_files[0].name) == remote_files[0].md5sum
+        assert md5_file(local_dir / "a" / "b" / remote_files[1].name) == remote_files[1].md5sum
+        assert set(manifest.values()) == {f.id for f in remote_files}
+
+        # Complete files are skipped, modified ones downloaded again
+        local_file = local_dir / remote_files[0].name
+        local_file.write_bytes(os.urandom(1024))
+        remote_tmp_subdir.download_tree(str(local_dir), workers=2)
+        assert md5_file(local_file) == remote_files[0].md5sum
+
+    def test_upload_tree(self, tmp_path: Path, remote_tmp_subdir: DriveFolder):
+        local_dir = tmp_path / "tree"
+        (local_dir / "a" / "b").mkdir(parents=True)
+        (local_dir / "empty").mkdir()
+        local_files = [local_dir / "file", local_dir / "a" / "b" / "file"]
+        for local_file in local_files:
+            local_file.write_bytes(os.urandom(1024))
+
+        manifest = remote_tmp_subdir.upload_tree(str(local_dir), workers=2)
+        assert set(manifest) == {str(local_file) for local_file in local_files}
+        assert remote_tmp_subdir.child_from_path("a/b/file").id == manifest[str(local_files[1])]
+        assert md5_file(local_files[1]) == remote_tmp_subdir.child_from_path("a/b/file").md5sum
+        assert remote_tmp_subdir.child("empty").isfolder()
+
+        # Uploaded files are not uploaded again
+        assert remote_tmp_subdir.upload_tree(str(local_dir), workers=2) == manifest
+
+    def test_pack_store(self, remote_tmp_subdir: DriveFolder):
+        members = {str(i): os.urandom(1000) for i in range(20)}
+        with PackStore(remote_tmp_subdir, pack_size=8000) as packs:
+            for name, data in members.items():
+                packs.add(name, data)
+        assert len(list(remote_tmp_subdir.children())) == 3
+
+        packs = PackStore(remote_tmp_subdir)
+        packs.load()
+        assert set(packs.index) == set(members)
+        assert packs.read("7") == members["7"]
+
+    def test_dedup_store(self, tmp_path: Path, remote_tmp_subdir: DriveFolder):
+        local_file = tmp_path / "image"
+        data = os.urandom(1024*1024*3)
+        local_file.write_bytes(data)
+        with DedupStore(remote_tmp_subdir, str(tmp_path / "index.db")) as store:
+            store.backup(str(local_file), "first")
+            local_file.write_bytes(data[:1024*1024] + b"changed" + data[1024*1024:])
+            stats = store.backup(str(local_file), "second")
+            assert stats['new_bytes'] < stats['bytes'] / 2
+            assert store.snapshots() == ["first", "second"]
+
+        # The index is rebuilt from the packs
+        with DedupStore(remote_tmp_subdir, str(tmp_path / "index2.db")) as store:
+            restored = tmp_path / "restored"
+            store.restore("first", str(restored), workers=2)
+            assert restored.read_bytes() == data
+
     def test_isempty(self, remote_tmp_subdir: DriveFolder):
         assert remote_tmp_subdir.isempty() == True
         remote_tmp_subdir.new_file(random_string()).upload_empty()
@@ -318,6 +392,34 @@ class TestDriveFile:
         remote_file.download(str(local_file), chunksize=chunksize, progress_handler=progress.update_status)
         assert progress.chunks_since_last_abort == 1
 
+    @pytest.mark.skipif(not ResumableMD5.supported(), reason="libcrypto not available")
+    def test_download_resume_checkpoint(self, tmpfile: Path, remote_tmpfile: DriveFile):
+        chunksize = chunksize_min
+        remote_file = remote_tmpfile(size_bytes=chunksize*2)
+        local_file = tmpfile(filename=remote_file.name)
+        checkpoint = Path(str(local_file)+checkpointSuffix)
+        progress = ProgressExtractor(abort_at=0.0)
+        with pytest.raises(AbortTransfer):
+            remote_file.download(str(local_file), chunksize=chunksize, progress_handler=progress.update_status)
+        assert checkpoint.exists()
+        remote_file.download(str(local_file), chunksize=chunksize)
+        assert not checkpoint.exists()
+        assert md5_file(local_file) == remote_file.md5sum
+
+    @pytest.mark.skipif(not ResumableMD5.supported(), reason="libcrypto not available")
+    def test_download_resume_older_checkpoint(self, tmpfile: Path, remote_tmpfile: DriveFile):
+        chunksize = chunksize_min
+        remote_file = remote_tmpfile(size_bytes=chunksize*2)
+        local_file = tmpfile(filename=remote_file.name)
+        progress = ProgressExtractor(abort_at=0.0)
+        with pytest.raises(AbortTransfer):
+            remote_file.download(str(local_file), chunksize=chunksize, progress_handler=progress.update_status)
+        # Written after the checkpoint, as by a process that was killed
+        with local_file.open('ab') as fh:
+            fh.write(b"x"*100)
+        remote_file.download(str(local_file), chunksize=chunksize)
+        assert md5_file(local_file) == remote_file.md5sum
+
     def test_download_local_file_does_not_match(self, tmpfile: Path, remote_tmpfile: DriveFile):
         chunksize = chunksize_min
         remote_file = remote_tmpfile(size_bytes=chunksize*2)
@@ -337,6 +439,177 @@ class TestDriveFile:
         remote_file.download(str(local_file), chunksize=chunksize)
         assert md5_file(local_file) == remote_file.md5sum
 
+    def test_download_parallel(self, tmpfile: Path, remote_tmpfile: DriveFile):
+        chunksize = chunksize_min
+        remote_file = remote_tmpfile(size_bytes=chunksize*5+100)
+        local_file = tmpfile()
+        remote_file.download(str(local_file), chunksize=chunksize, workers=4)
+        assert md5_file(local_file) == remote_file.md5sum
+
+    def test_download_parallel_resume(self, tmpfile: Path, remote_tmpfile: DriveFile):
+        chunksize = chunksize_min
+        remote_file = remote_tmpfile(size_bytes=chunksize*5)
+        local_file = tmpfile(filename=remote_file.name)
+        progress = ProgressExtractor(abort_at=0.0)
+        with pytest.raises(AbortTransfer):
+            remote_file.download(str(local_file), chunksize=chunksize, workers=2,
+                                    progress_handler=progress.update_status)
+        assert local_file.stat().st_size % chunksize == 0
+        remote_file.download(str(local_file), chunksize=chunksize, workers=2)
+        assert md5_file(local_file) == remote_file.md5sum
+
+    def test_download_stream(self, tmpfile: Path, remote_tmpfile: DriveFile):
+        chunksize = chunksize_min
+        remote_file = remote_tmpfile(size_bytes=chunksize*3+100)
+        local_file = tmpfile(filename=remote_file.name)
+        progress = ProgressExtractor(abort_at=0.0)
+        with pytest.raises(AbortTransfer):
+            remote_file.download(str(local_file), chunksize=chunksize, stream=True,
+                                    progress_handler=progress.update_status)
+        assert progress.status.resumable_progress == chunksize
+        remote_file.download(str(local_file), chunksize=chunksize, stream=True)
+        assert md5_file(local_file) == remote_file.md5sum
+
+    def test_iter_content(self, tmpfile: Path, remote_tmpfile: DriveFile):
+        remote_file = remote_tmpfile(size_bytes=chunksize_min*2+100)
+        content = b"".join(remote_file.iter_content(chunksize=chunksize_min))
+        assert md5(content).hexdigest() == remote_file.md5sum
+
+        partial = b"".join(remote_file.iter_content(offset=100, length=chunksize_min))
+        assert partial == content[100:chunksize_min+100]
+
+    def test_iter_content_after_remote_update(self, tmpfile: Path, remote_tmpfile: DriveFile):
+        remote_file = remote_tmpfile(size_bytes=1024)
+        assert remote_file.md5sum
+        local_file = tmpfile(size_bytes=2048)
+        remote_file.parent.child(remote_file.name).upload(str(local_file))
+        assert b"".join(remote_file.iter_content()) == local_file.read_bytes()
+        buffer = bytearray(2048)
+        remote_file.download_into(buffer)
+        assert buffer == local_file.read_bytes()
+
+    def test_iter_content_nonexistent(self, remote_tmpdir: DriveFolder):
+        new_file = remote_tmpdir.new_file(random_string())
+        with pytest.raises(FileNotFoundError):
+            new_file.iter_content()
+
+    def test_open_read_seek(self, remote_tmpfile: DriveFile):
+        remote_file = remote_tmpfile(size_bytes=chunksize_min*2)
+        content = b"".join(remote_file.iter_content())
+        with remote_file.open('rb') as fh:
+            assert fh.read(100) == content[:100]
+            fh.seek(-100, os.SEEK_END)
+            assert fh.read(100) == content[-100:]
+            assert fh.read(100) == b""
+            fh.seek(chunksize_min)
+            assert fh.tell() == chunksize_min
+            assert fh.read() == content[chunksize_min:]
+
+    def test_open_read_across_buffer(self, remote_tmpfile: DriveFile):
+        remote_file = remote_tmpfile(size_bytes=chunksize_min*2)
+        content = b"".join(remote_file.iter_content())
+        with remote_file.open('rb') as fh:
+            fh.read(10)
+            fh.seek(minimalReadahead-5)
+            assert fh.read(100) == content[minimalReadahead-5:minimalReadahead+95]
+
+    def test_open_write(self, remote_tmpdir: DriveFolder):
+        chunksize = chunksize_min
+        content = os.urandom(chunksize*2+100)
+        remote_file = remote_tmpdir.new_file(random_string())
+        with remote_file.open('wb', chunksize=chunksize) as fh:
+            for i in range(0, len(content), 1000):
+                fh.write(content[i:i+1000])
+        assert remote_file.id
+        assert md5(content).hexdigest() == remote_file.md5sum
+
+    def test_open_write_abort(self, remote_tmpdir: DriveFolder):
+        remote_file = remote_tmpdir.new_file(random_string())
+        with pytest.raises(AbortTransfer):
+            with remote_file.open('wb') as fh:
+                fh.write(b"abc")
+                raise AbortTransfer
+        assert remote_file.id == None
+
+    def test_open_unsupported_mode(self, remote_tmpfile: DriveFile):
+        remote_file = remote_tmpfile(size_bytes=100)
+        with pytest.raises(ValueError):
+            remote_file.open('r+')
+
+    def test_open_with_block_cache(self, tmp_path: Path, remote_tmpfile: DriveFile):
+        block_size = 1024
+        remote_file = remote_tmpfile(size_bytes=block_size*8)
+        content = b"".join(remote_file.iter_content())
+        cache = BlockCache(str(tmp_path / "cache"), max_bytes=block_size*4, block_size=block_size)
+        with remote_file.open('rb', cache=cache) as fh:
+            fh.seek(block_size+10)
+            assert fh.read(10) == content[block_size+10:block_size+20]
+        # Readahead blocks are not counted
+        assert cache.misses == 1
+        assert cache.size <= block_size*4
+
+        with remote_file.open('rb', cache=cache) as fh:
+            fh.seek(block_size+10)
+            assert fh.read(10) == content[block_size+10:block_size+20]
+        assert cache.hits > 0
+
+    def test_download_with_cache(self, tmp_path: Path, tmpfile: Path, remote_tmpfile: DriveFile):
+        remote_file = remote_tmpfile(size_bytes=1024)
+        cache = DownloadCache(str(tmp_path / "cache"), max_bytes=1024*1024)
+        local_file = tmpfile()
+        remote_file.download(str(local_file), cache=cache)
+        assert cache.misses == 1
+
+        local_file2 = tmpfile()
+        remote_file.download(str(local_file2), cache=cache)
+        assert cache.hits == 1
+        assert md5_file(local_file2) == remote_file.md5sum
+
+        # A placed copy can be written without touching the cache entry
+        with local_file2.open('r+b') as fh:
+            fh.write(b"XX")
+        local_file3 = tmpfile()
+        remote_file.download(str(local_file3), cache=cache)
+        assert md5_file(local_file3) == remote_file.md5sum
+
+    def test_download_pinned_revision(self, tmpfile: Path, remote_tmpfile: DriveFile):
+        chunksize = chunksize_min
+        remote_file = remote_tmpfile(size_bytes=chunksize*2)
+        local_file = tmpfile(filename=remote_file.name)
+        progress = ProgressExtractor(abort_at=0.0)
+        with pytest.raises(AbortTransfer):
+            remote_file.download(str(local_file), chunksize=chunksize, pin_revision=True,
+                                    progress_handler=progress.update_status)
+        assert remote_file.download_revision == remote_file.meta_get("headRevisionId")["headRevisionId"]
+        remote_file.download(str(local_file), chunksize=chunksize, pin_revision=True)
+        assert remote_file.download_revision == None
+        assert md5_file(local_file) == remote_file.md5sum
+
+    def test_download_pinned_revision_gone(self, tmpfile: Path, remote_tmpfile: DriveFile):
+        chunksize = chunksize_min
+        remote_file = remote_tmpfile(size_bytes=chunksize*2)
+        local_file = tmpfile(size_bytes=chunksize)
+        remote_file.download_revision = "doesnotexist"
+        with pytest.raises(RemoteFileChangedError):
+            remote_file.download(str(local_file), chunksize=chunksize, pin_revision=True)
+        assert not local_file.exists()
+        assert remote_file.download_revision == None
+
+    def test_download_into(self, remote_tmpfile: DriveFile):
+        remote_file = remote_tmpfile(size_bytes=chunksize_min*2+100)
+        buffer = bytearray(remote_file.size)
+        assert remote_file.download_into(buffer, chunksize=chunksize_min) == remote_file.size
+        assert md5(buffer).hexdigest() == remote_file.md5sum
+
+        partial = bytearray(100)
+        assert remote_file.download_into(partial, offset=chunksize_min, length=100) == 100
+        assert partial == buffer[chunksize_min:chunksize_min+100]
+
+    def test_download_into_buffer_too_small(self, remote_tmpfile: DriveFile):
+        remote_file = remote_tmpfile(size_bytes=1024)
+        with pytest.raises(ValueError):
+            remote_file.download_into(bytearray(1023))
+
     def test_upload(self, tmpfile: Path, remote_tmpdir: DriveFolder):
         local_file = tmpfile(size_bytes = 1024)
         
@@ -350,6 +623,157 @@ class TestDriveFile:
         remote_file.upload(str(local_file), chunksize=None)
         assert md5_file(local_file) == remote_file.md5sum
 
+    def test_upload_mmap(self, tmpfile: Path, remote_tmpdir: DriveFolder):
+        chunksize = chunksize_min
+        local_file = tmpfile(size_bytes=chunksize*3+100)
+        remote_file = remote_tmpdir.new_file(local_file.name)
+        progress = ProgressExtractor(abort_at=0.0)
+        with pytest.raises(AbortTransfer):
+            remote_file.upload(str(local_file), chunksize=chunksize, use_mmap=True,
+                                progress_handler=progress.update_status)
+        remote_file.upload(str(local_file), chunksize=chunksize, use_mmap=True)
+        assert md5_file(local_file) == remote_file.md5sum
+
+    def test_upload_prefetch(self, tmpfile: Path, remote_tmpdir: DriveFolder):
+        chunksize = chunksize_min
+        local_file = tmpfile(size_bytes=chunksize*5)
+        remote_file = remote_tmpdir.new_file(local_file.name)
+        progress = ProgressExtractor(abort_at=0.4)
+        with pytest.raises(AbortTransfer):
+            remote_file.upload(str(local_file), chunksize=chunksize, prefetch=2,
+                                progress_handler=progress.update_status)
+        assert progress.status.resumable_progress == 2*chunksize
+        progress.abort_at = 1
+        remote_file.upload(str(local_file), chunksize=chunksize, prefetch=2,
+                            progress_handler=progress.update_status)
+        assert progress.chunks_since_last_abort == 3
+        assert md5_file(local_file) == remote_file.md5sum
+
+    def test_upload_stream(self, remote_tmpdir: DriveFolder):
+        chunksize = chunksize_min
+        content = os.urandom(chunksize*2+100)
+
+        remote_file = remote_tmpdir.new_file(random_string())
+        remote_file.upload_stream(io.BytesIO(content), chunksize=chunksize)
+        assert md5(content).hexdigest() == remote_file.md5sum
+
+        remote_file = remote_tmpdir.new_file(random_string())
+        pieces = (content[i:i+1000] for i in range(0, len(content), 1000))
+        remote_file.upload_stream(pieces, chunksize=chunksize)
+        assert md5(content).hexdigest() == remote_file.md5sum
+
+    def test_upload_stream_empty(self, remote_tmpdir: DriveFolder):
+        remote_file = remote_tmpdir.new_file(random_string())
+        remote_file.upload_stream(iter(()))
+        assert remote_file.md5sum == md5().hexdigest()
+
+    def test_upload_multipart(self, tmpfile: Path, remote_tmpdir: DriveFolder):
+        local_file = tmpfile(size_bytes=4096)
+        remote_file = remote_tmpdir.new_file(local_file.name)
+        progress = ProgressExtractor(abort_at=1)
+        remote_file.upload(str(local_file), progress_handler=progress.update_status)
+        assert progress.chunks == 1
+        assert progress.status.resumable_uri == None
+        assert remote_file.id
+        assert md5_file(local_file) == remote_file.md5sum
+
+    def test_upload_journal_resume(self, tmpfile: Path, remote_tmpdir: DriveFolder, tmp_path: Path):
+        chunksize = chunksize_min
+        local_file = tmpfile(size_bytes=chunksize*5)
+        remote_file = remote_tmpdir.new_file(local_file.name)
+        progress = ProgressExtractor(abort_at=0.4)
+        with UploadJournal(str(tmp_path / "journal.db")) as journal:
+            with pytest.raises(AbortTransfer):
+                remote_file.upload(str(local_file), chunksize=chunksize,
+                                    progress_handler=progress.update_status, journal=journal)
+        # A new process only has the journal
+        with UploadJournal(str(tmp_path / "journal.db")) as journal:
+            assert [entry[3] for entry in journal.pending()] == [2*chunksize]
+            uploaded = journal.resume_all(remote_tmpdir.drive, chunksize=chunksize)
+            assert journal.pending() == []
+        assert md5_file(local_file) == uploaded[str(local_file)].md5sum
+
+    def test_upload_journal_session_gone(self, tmpfile: Path, remote_tmpdir: DriveFolder, tmp_path: Path):
+        chunksize = chunksize_min
+        local_file = tmpfile(size_bytes=chunksize*2)
+        remote_file = remote_tmpdir.new_file(local_file.name)
+        with UploadJournal(str(tmp_path / "journal.db")) as journal:
+            journal.record(str(local_file), remote_file,
+                "https://www.googleapis.com/upload/drive/v3/files?uploadType=resumable&upload_id=gone",
+                chunksize)
+            remote_file.upload(str(local_file), chunksize=chunksize, journal=journal)
+            assert journal.pending() == []
+        assert md5_file(local_file) == remote_file.md5sum
+
+    def test_upload_session_pool(self, tmpfile: Path, remote_tmpdir: DriveFolder):
+        chunksize = chunksize_min
+        local_file = tmpfile(size_bytes=chunksize*2)
+        remote_file = remote_tmpdir.new_file(local_file.name)
+        with UploadSessionPool(remote_tmpdir.drive) as pool:
+            pool.prepare(remote_file)
+            remote_file.upload(str(local_file), chunksize=chunksize, session_pool=pool)
+            assert pool.hit_rate == 1
+        # Only the data requests
+        assert remote_file.upload_http_calls == 2
+        assert md5_file(local_file) == remote_file.md5sum
+
+    def test_upload_session_pool_app_properties(self, tmpfile: Path, remote_tmpdir: DriveFolder):
+        chunksize = chunksize_min
+        local_file = tmpfile(size_bytes=chunksize*2)
+        remote_file = remote_tmpdir.new_file(local_file.name)
+        with UploadSessionPool(remote_tmpdir.drive) as pool:
+            pool.prepare(remote_file, {'origin': 'test'})
+            remote_file.upload(str(local_file), chunksize=chunksize, session_pool=pool,
+                                app_properties={'origin': 'test'})
+            assert pool.hit_rate == 1
+        assert remote_file.meta_get("appProperties")['appProperties'] == {'origin': 'test'}
+
+    def test_upload_download_gzip(self, tmp_path: Path, remote_tmpdir: DriveFolder):
+        local_file = tmp_path / "log.txt"
+        local_file.write_bytes(b"compressible line\n" * 100000)
+        remote_file = remote_tmpdir.new_file(local_file.name)
+        remote_file.upload(str(local_file), codec="gzip", app_properties={'origin': 'test'})
+        assert remote_file.size < local_file.stat().st_size
+        app_properties = remote_file.meta_get("appProperties")["appProperties"]
+        assert app_properties["drivelibMd5"] == md5_file(local_file)
+        assert app_properties["origin"] == "test"
+        with pytest.raises(ValueError):
+            remote_file.upload(str(local_file), codec="gzip", use_mmap=True)
+
+        download = tmp_path / "download.txt"
+        remote_file.download(str(download), decode=True)
+        assert md5_file(download) == md5_file(local_file)
+
+    def test_upload_download_striped(self, tmpfile: Path, tmp_path: Path, remote_tmp_subdir: DriveFolder):
+        chunksize = chunksize_min
+        local_file = tmpfile(size_bytes=chunksize*5+100)
+        remote_file = remote_tmp_subdir.new_file(local_file.name)
+        remote_file.upload_striped(str(local_file), stripes=3, workers=3, chunksize=chunksize)
+        # Only the manifest and the folder of the parts are visible
+        assert sorted(item.name for item in remote_tmp_subdir.children()) == [".stripes", local_file.name]
+        assert remote_file.striped_state is None
+
+        download = tmp_path / "download"
+        remote_file.download(str(download), decode=True, workers=3)
+        assert md5_file(download) == md5_file(local_file)
+
+        # Trees hold the reassembled file
+        remote_tmp_subdir.download_tree(str(tmp_path / "tree"))
+        assert os.listdir(str(tmp_path / "tree")) == [local_file.name]
+        assert md5_file(tmp_path / "tree" / local_file.name) == md5_file(local_file)
+
+        remote_file.remove()
+        assert remote_tmp_subdir.child(".stripes").isempty()
+
+    def test_upload_round_trips(self, tmpfile: Path, remote_tmpdir: DriveFolder):
+        chunksize = chunksize_min
+        local_file = tmpfile(size_bytes=chunksize*2)
+        remote_file = remote_tmpdir.new_file(local_file.name)
+        remote_file.upload(str(local_file), chunksize=chunksize)
+        # Session creation and one request per chunk
+        assert remote_file.upload_http_calls == 3
+        assert md5_file(local_file) == remote_file.md5sum
+
     def test_upload_empty_file(self, tmpfile: Path, remote_tmpdir: DriveFolder):
         local_file = tmpfile(size_bytes = 0)
         remote_file = remote_tmpdir.new_file(str(local_file.parent))
@@ -445,8 +869,21 @@ class TestDriveFile:
         local_file = tmpfile(size_bytes=1024)
         remote_file = remote_tmpfile(size_bytes=1024)
         id_pre_upload = remote_file.id
-        with pytest.raises(FileExistsError):
-            remote_file.upload(str(local_file))
+        md5_pre_upload = remote_file.md5sum
+        remote_file.upload(str(local_file))
+        assert remote_file.id == id_pre_upload
+        assert remote_file.md5sum != md5_pre_upload
+        assert remote_file.md5sum == md5_file(local_file)
+        assert remote_file.meta_get("md5Checksum")["md5Checksum"] == md5_file(local_file)
+
+    def test_upload_existing_file_unchanged(self, tmpfile: Path, remote_tmpdir: DriveFolder):
+        local_file = tmpfile(size_bytes=chunksize_min*2)
+        remote_file = remote_tmpdir.new_file(local_file.name)
+        remote_file.upload(str(local_file), chunksize=chunksize_min)
+        id_pre_upload = remote_file.id
+        remote_file.upload(str(local_file), chunksize=chunksize_min)
+        # Only the metadata request, no content sent
+        assert remote_file.upload_http_calls == 1
         assert remote_file.id == id_pre_upload
 
     def test_upload_resume_deleted(self, tmpfile: Path, remote_tmpdir: DriveFolder):
@@ -488,6 +925,42 @@ class TestDriveFile:
 
 
 
+class TestResumableMD5:
+    @pytest.mark.skipif(not ResumableMD5.supported(), reason="libcrypto not available")
+    def test_state_roundtrip(self):
+        content = os.urandom(1000)
+        range_md5 = ResumableMD5()
+        range_md5.update(content[:300])
+        restored = ResumableMD5(range_md5.state())
+        restored.update(memoryview(content)[300:])
+        assert restored.length == len(content)
+        assert restored.hexdigest() == md5(content).hexdigest()
+
+    @pytest.mark.skipif(not ResumableMD5.supported(), reason="libcrypto not available")
+    def test_upload_resume_with_checkpoint(self, tmpfile: Path,
+                                            remote_tmpdir: DriveFolder):
+        chunksize = chunksize_min
+        local_file = tmpfile(size_bytes=chunksize*3)
+        remote_file = remote_tmpdir.new_file(local_file.name)
+        progress = ProgressExtractor(abort_at=0.0)
+        with pytest.raises(AbortTransfer):
+            remote_file.upload(
+                                str(local_file),
+                                chunksize=chunksize,
+                                progress_handler=progress.update_status
+                            )
+        assert progress.status.resumable_checkpoint
+        remote_file = remote_tmpdir.new_file(local_file.name)
+        remote_file.upload(
+                            str(local_file),
+                            chunksize=chunksize,
+                            resumable_uri=progress.status.resumable_uri,
+                            resumable_checkpoint=progress.status.resumable_checkpoint
+                        )
+        assert md5_file(local_file) == remote_file.md5sum
+        assert remote_file.resumable_checkpoint == None
+
+
 class TestMetadata:
     def test_get_metadata(self, remote_tmpfile: DriveFile):
         remote_file = remote_tmpfile(size_bytes=700)